@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import csv
+import io
+import json
+from collections import deque
+from pathlib import Path
+from typing import AsyncIterator, List
+from .src import graph
+from .config import settings
+from . import utils
+
+
+'''
+Bulk classification of job descriptions, e.g. the free-text answers of a survey.
+Every row runs the graph once without the human step(graph.get_batch_graph()): MATCH_FOUND rows come back with the selected
+code, MORE_INFO rows come back as UNRESOLVED with the clarification question the analyzer would have asked.
+Rows are classified with bounded concurrency and their llm calls go through the dispatcher with the lowest priority,
+so the rate limits are respected and chat users are served first.
+
+Results are yielded as one json object per row in the order of the input, so the number of result lines received is the
+progress of the batch: an interrupted batch is resumed by sending it again with start_at = number of lines already received.
+Used by POST /batch/classify and from the command line:
+    python -m app.batch descriptions.csv -o results.ndjson          (add --resume to continue an interrupted run)
+'''
+
+TEXT_FIELDS = ("description", "job_description", "text", "user_message")      # first one found in the input is used
+
+
+class BatchInputError(ValueError):
+    pass
+
+
+def parse_rows(content: str, input_format: str) -> List[dict]:
+    '''Rows of {"id", "description"} from csv(with a header) or ndjson. The id defaults to the row number'''
+    if input_format == "csv":
+        records = list(csv.DictReader(io.StringIO(content)))
+    elif input_format == "ndjson":
+        try:
+            records = [json.loads(line) for line in content.splitlines() if line.strip()]
+        except json.JSONDecodeError as e:
+            raise BatchInputError(f"invalid json line: {e}")
+    else:
+        raise BatchInputError(f"unknown format {input_format}, use csv or ndjson")
+
+    rows = []
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise BatchInputError(f"row {index} is not an object")
+        text_field = next((field for field in TEXT_FIELDS if field in record), None)
+        if text_field is None:
+            raise BatchInputError(f"row {index} has none of the columns {', '.join(TEXT_FIELDS)}")
+        rows.append({"id": str(record.get("id") or index), "description": str(record[text_field] or "").strip()})
+    return rows
+
+
+async def classify(description: str) -> dict:
+    if not description:
+        return {"status": "UNRESOLVED", "result": "Empty description."}
+    result = await graph.get_batch_graph().ainvoke(utils.generate_initial_state(description), config={"configurable": {"batch": True}})
+    analyzer_response = result["analyzer_response"]
+    if analyzer_response.status == "MATCH_FOUND":
+        return {
+            "status": "MATCH_FOUND",
+            "result": result["messages"][-1].content,
+            "code": ", ".join(analyzer_response.selected_code),       # normalized to a list, usually one code
+            "title": ", ".join(analyzer_response.selected_title),
+            "confidence": analyzer_response.confidence_score
+        }
+    return {"status": "UNRESOLVED", "result": analyzer_response.user_message or analyzer_response.system_directive}
+
+
+async def run_batch(rows: List[dict], concurrency: int, start_at: int = 0) -> AsyncIterator[dict]:
+
+    '''Classifies rows[start_at:], at most concurrency rows at a time, and yields the results in input order'''
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def classify_row(index: int, row: dict) -> dict:
+        async with semaphore:
+            try:
+                outcome = await classify(row["description"])
+            except Exception as e:
+                print(f"batch row {index} failed:", e)
+                outcome = {"status": "ERROR", "result": str(e)[:200]}
+        return {"index": index, "id": row["id"], **outcome}
+
+    window = max(1, concurrency) * 4        # rows started ahead of the one being waited on, bounds the results held back by a slow row
+    pending = deque()
+    next_index = start_at
+    try:
+        while next_index < len(rows) or pending:
+            while next_index < len(rows) and len(pending) < window:
+                pending.append(asyncio.create_task(classify_row(next_index, rows[next_index])))
+                next_index += 1
+            yield await pending.popleft()
+    finally:
+        for task in pending:        # the client went away: queued llm calls of these rows are dropped by the dispatcher, calls already sent finish
+            task.cancel()
+
+
+async def run_file(input_path: Path, output_path: Path, concurrency: int, resume: bool):
+    input_format = "csv" if input_path.suffix.lower() == ".csv" else "ndjson"
+    rows = parse_rows(input_path.read_text(encoding="utf-8"), input_format)
+    start_at = 0
+    if resume and output_path.exists():
+        with open(output_path, "r", encoding="utf-8") as f:
+            start_at = sum(1 for line in f if line.strip())
+    print(f"classifying {len(rows) - start_at} of {len(rows)} rows with concurrency {concurrency}")
+
+    if settings.vector_index_enabled:
+        try:
+            await asyncio.to_thread(utils.load_catalogue_index)
+        except Exception as e:
+            print("could not load the catalogue index, falling back to chroma:", e)
+    counts = {}
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as f:
+        async for result in run_batch(rows, concurrency, start_at):
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+            if (result["index"] + 1) % 100 == 0:
+                print(f"{result['index'] + 1}/{len(rows)} rows: {counts}")
+    print(f"done: {counts}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify a csv/ndjson file of job descriptions")
+    parser.add_argument("input", type=Path, help="csv with a header or ndjson, with a description(or text) column and an optional id")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="ndjson file with one result per row")
+    parser.add_argument("--concurrency", type=int, default=settings.batch_concurrency)
+    parser.add_argument("--resume", action="store_true", help="skip the rows already in the output file")
+    args = parser.parse_args()
+    asyncio.run(run_file(args.input, args.output, args.concurrency, args.resume))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import List
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from .database import checkpointer_pool
+from .config import settings
+from . import utils, metrics
+
+
+'''
+Lightweight thread-existence checks against the checkpointer.
+The chat routers only need to know whether a thread already has checkpoints(start must not reuse a thread, resume needs one),
+aget_tuple answers that by loading and deserializing the latest checkpoint with its pending writes. Here it is a keys-only
+lookup on the primary key of the checkpoints table, backed by a small in-process cache of threads known to exist.
+Checkpoints of many threads are deleted together(reaper, deletion queue) with one DELETE per table for a chunk of thread ids.
+
+Only existence is cached, never absence. A cached thread can be stale if another worker deleted its checkpoints, but that only
+happens for threads that are closed in the user-database, and the routers validate the session before asking here.
+'''
+
+THREAD_EXISTS = "SELECT 1 FROM checkpoints WHERE thread_id = %s AND checkpoint_ns = '' LIMIT 1"
+CHECKPOINT_TABLES = ("checkpoint_writes", "checkpoint_blobs", "checkpoints")
+DELETE_CHUNK = 100      # thread ids per DELETE
+
+
+class KnownThreads:
+
+    '''LRU set of thread ids known to have checkpoints, entries expire after ttl seconds'''
+
+    def __init__(self, ttl: float = 300, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, float]" = OrderedDict()     # thread_id -> expires_at
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, thread_id: str) -> bool:
+        expires_at = self.entries.get(thread_id)
+        if expires_at is None or expires_at < time.monotonic():
+            self.entries.pop(thread_id, None)
+            self.misses += 1
+            return False
+        self.entries.move_to_end(thread_id)
+        self.hits += 1
+        return True
+
+    def add(self, thread_id: str):
+        self.entries[thread_id] = time.monotonic() + self.ttl
+        self.entries.move_to_end(thread_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def discard(self, thread_id: str):
+        self.entries.pop(thread_id, None)
+
+
+known_threads = KnownThreads(ttl=settings.thread_cache_ttl, max_size=settings.thread_cache_size)
+
+
+async def thread_exists(thread_id: str) -> bool:
+    if thread_id in known_threads:
+        return True
+    if isinstance(utils.get_checkpointer(), AsyncPostgresSaver):
+        with metrics.CHECKPOINTER_SECONDS.time(operation="thread_exists"):
+            async with checkpointer_pool.connection() as conn:
+                cursor = await conn.execute(THREAD_EXISTS, (thread_id,))
+                exists = await cursor.fetchone() is not None
+    else:       # other savers(e.g. the InMemorySaver of the benchmarks) don't have the checkpoints table
+        with metrics.CHECKPOINTER_SECONDS.time(operation="aget_tuple"):
+            exists = await utils.get_checkpointer().aget_tuple({"configurable": {"thread_id": thread_id}}) is not None
+    if exists:
+        known_threads.add(thread_id)
+    return exists
+
+
+def mark_exists(thread_id: str):
+    '''Called after a graph run left checkpoints for the thread(MORE_INFO)'''
+    known_threads.add(thread_id)
+
+
+def forget(thread_id: str):
+    '''Called when the checkpoints of the thread are deleted'''
+    known_threads.discard(thread_id)
+
+
+async def _delete_chunk(thread_ids: List[str], semaphore: asyncio.Semaphore) -> int:
+    async with semaphore:
+        if not isinstance(utils.get_checkpointer(), AsyncPostgresSaver):
+            for thread_id in thread_ids:
+                await utils.get_checkpointer().adelete_thread(thread_id)
+            return 0
+        deleted = 0
+        async with checkpointer_pool.connection() as conn:
+            with metrics.CHECKPOINTER_SECONDS.time(operation="delete_threads"):
+                async with conn.transaction():
+                    for table in CHECKPOINT_TABLES:
+                        cursor = await conn.execute(f"DELETE FROM {table} WHERE thread_id = ANY(%s)", (thread_ids,))
+                        deleted += cursor.rowcount
+        return deleted
+
+
+async def delete_threads(thread_ids: List[str], concurrency: int = 2) -> int:
+    '''Deletes the checkpoints of the threads in chunks with at most concurrency deletes at a time, returns the number of rows deleted'''
+    for thread_id in thread_ids:
+        forget(thread_id)
+    semaphore = asyncio.Semaphore(concurrency)
+    chunks = [thread_ids[i:i + DELETE_CHUNK] for i in range(0, len(thread_ids), DELETE_CHUNK)]
+    return sum(await asyncio.gather(*(_delete_chunk(chunk, semaphore) for chunk in chunks)))
@@ -20,6 +20,55 @@ class Settings(BaseSettings):
     allowed_url1: str
     allowed_url2: str
     allowed_url3: str
+    vector_index_enabled: bool = True      # in-process numpy index for retrieval, chroma is used as fallback if disabled or not loaded
+    vector_index_mmap: bool = True         # memory-map the cached catalogue vectors instead of reading them in memory
+    vector_index_quantization: str = "none"    # none or int8: coarse scan over an int8 copy and exact rerank of the shortlist, saves memory but scans slower
+    vector_index_rerank_candidates: int = 50   # rows of the coarse scan scored again in float32
+    hybrid_retrieval: bool = False         # fuse the vector search with a BM25 index over the titles and descriptions(needs the vector index)
+    hybrid_candidates: int = 50            # candidates taken from each ranking before the fusion
+    rrf_k: int = 60                        # reciprocal-rank fusion constant, higher flattens the rank differences
+    division_retrieval: bool = False       # search only the division named in the expander query(needs the vector index), whole catalogue as fallback
+    division_min_similarity: float = 0.5   # cosine similarity of the best hit in the division below which the whole catalogue is searched
+    query_cache_size: int = 2048           # max number of query embeddings kept in the LRU cache
+    query_cache_persist: bool = False      # save the query embeddings cache on shutdown and load it on startup
+    response_cache_enabled: bool = False   # reuse the whole classification for near identical first messages
+    response_cache_threshold: float = 0.95  # min cosine similarity of first messages to reuse a cached classification
+    response_cache_ttl: int = 3600         # seconds
+    response_cache_size: int = 512
+    speculative_search: bool = False       # search the raw user message while the expander runs and merge its hits with the expander query hits
+    speculative_search_results: int = 3    # hits of the speculative search added to the 5 of the expander query
+    llm_requests_per_minute: int = 0       # token bucket on Groq requests, per worker process(divide the quota by the workers), 0 disables the limit
+    llm_tokens_per_minute: int = 0         # token bucket on Groq tokens(prompt + expected completion), per worker process, 0 disables the limit
+    llm_max_concurrency: int = 8           # max llm calls in flight at a time
+    batch_api_key: Optional[str] = None    # X-Api-Key of POST /batch/classify, the endpoint is disabled without it
+    batch_concurrency: int = 8             # rows of a batch classified at a time
+    batch_max_rows: int = 50000
+    heartbeat_buffer_enabled: bool = True   # write thread_last_used_at in bulk from a background task instead of on every request
+    heartbeat_flush_interval: float = 5.0   # seconds between heartbeat flushes
+    reaper_enabled: bool = True            # time based cleanup of abandoned threads and their checkpoints
+    thread_idle_ttl: int = 86400           # seconds after the last use(thread_last_used_at) when a thread is closed and its checkpoints deleted
+    reaper_interval: int = 600             # seconds between reaper runs
+    reaper_batch_size: int = 500           # sessions closed per statement
+    reaper_concurrency: int = 2            # concurrent checkpoint deletes, keep it below the checkpointer pool size
+    deletion_poll_interval: int = 30       # seconds between polls of pending_checkpoint_deletion for deletions left behind
+    deletion_batch_size: int = 100
+    thread_cache_ttl: int = 300            # seconds a thread known to have checkpoints is remembered
+    thread_cache_size: int = 10000
+    db_pool_size: int = 5                  # user-database(SQLAlchemy) connections kept in the pool
+    db_max_overflow: int = 10              # extra connections opened under load
+    db_pool_timeout: float = 30            # seconds to wait for a connection before failing
+    db_pool_recycle: int = 3000            # seconds after which a connection is replaced
+    db_pool_warmup: int = 2                # user-database connections opened at startup
+    checkpointer_pool_min_size: int = 2    # checkpointer(psycopg) connections opened at startup and kept open
+    checkpointer_pool_max_size: int = 8
+    checkpointer_pool_timeout: float = 30
+    checkpointer_pool_max_idle: float = 600    # seconds an idle connection above min_size is kept
+    checkpointer_pool_max_lifetime: float = 3600
+    pool_warmup: bool = True               # open the connections before serving the first request
+    lazy_startup: bool = False             # serve right away and warm up in the background, /readyz reports when it is done
+    onnx_intra_op_threads: int = 0         # threads of the query embedding model per process, 0 lets onnxruntime use every core
+    database_url: Optional[str] = None     # overrides the Neon user-database url, e.g. a local postgres for benchmarks(postgresql+asyncpg://...)
+    checkpointer_database_url: Optional[str] = None    # overrides the checkpointer-database url(postgresql://...)
     
     class Config:
         env_file = ".env"
@@ -29,5 +78,6 @@ settings=Settings()
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 EMBEDDINGS_PATH = Path(BASE_DIR / "embeddings") 
+INDEX_CACHE_PATH = Path(BASE_DIR / "embeddings_cache")     # cached catalogue vectors for the in-process index
 
 
@@ -1,11 +1,57 @@
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import exc
 import psycopg
 from psycopg.rows import dict_row
-from psycopg_pool import AsyncConnectionPool
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 from .config import settings
+from . import metrics
+import asyncio
 import asyncpg
 import ssl
+import time
+
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+
+    '''SQLAlchemy pool which records how long a checkout waits(including pre ping), how many checkouts are blocked and the timeouts'''
+
+    waiting = 0         # checkouts blocked on a full pool: no idle connection and no overflow left
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            metrics.POOL_TIMEOUTS.inc(pool="user_db")
+            raise
+        finally:
+            metrics.POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started, pool="user_db")
+
+    def _do_get(self):
+        if self.checkedin() > 0 or self._max_overflow < 0 or self._overflow < self._max_overflow:      # served right away
+            return super()._do_get()
+        TimedAsyncAdaptedQueuePool.waiting += 1
+        try:
+            return super()._do_get()
+        finally:
+            TimedAsyncAdaptedQueuePool.waiting -= 1
+
+
+class TimedAsyncConnectionPool(AsyncConnectionPool):
+
+    '''psycopg pool which records how long getting a connection waits and the timeouts, the rest comes from get_stats()'''
+
+    async def getconn(self, timeout=None):
+        started = time.perf_counter()
+        try:
+            return await super().getconn(timeout=timeout)
+        except PoolTimeout:
+            metrics.POOL_TIMEOUTS.inc(pool="checkpointer")
+            raise
+        finally:
+            metrics.POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started, pool="checkpointer")
 
 
 ssl_context = ssl.create_default_context()
@@ -13,13 +59,15 @@ ssl_context.check_hostname = True
 ssl_context.verify_mode = ssl.CERT_REQUIRED
 
 # setting up async user-database connection pool using SQLAlchemy.I am using Neon for this
-DATABASE_URL_USER = f"postgresql+asyncpg://neondb_owner:{settings.database_password}@{settings.database_host}.{settings.database_region}.aws.neon.tech/{settings.database_name}"
+DATABASE_URL_USER = settings.database_url or f"postgresql+asyncpg://neondb_owner:{settings.database_password}@{settings.database_host}.{settings.database_region}.aws.neon.tech/{settings.database_name}"
 engine = create_async_engine(
     DATABASE_URL_USER,
-    pool_size=3, 
-    max_overflow=5,
+    poolclass=TimedAsyncAdaptedQueuePool,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
     pool_pre_ping=True,
-    pool_recycle=3000
+    pool_recycle=settings.db_pool_recycle
 )
 print("created user engine")
 AsyncSessionLocal = async_sessionmaker(
@@ -38,12 +86,15 @@ async def get_db():
 
 
 #setting up checkpointer-database connection using psycopg and langgraph.Async version of PostgresSaver is being used here.
-DATABASE_URL_CHECKPOINTS = f'postgresql://{settings.checkpointer_db_username}:{settings.checkpointer_db_password}@{settings.checkpointer_db_host}:5432/{settings.checkpointer_db_dbname}'
-checkpointer_pool = AsyncConnectionPool(
+DATABASE_URL_CHECKPOINTS = settings.checkpointer_database_url or f'postgresql://{settings.checkpointer_db_username}:{settings.checkpointer_db_password}@{settings.checkpointer_db_host}:5432/{settings.checkpointer_db_dbname}'
+checkpointer_pool = TimedAsyncConnectionPool(
     conninfo=DATABASE_URL_CHECKPOINTS,
     open=False,
-    min_size=2,
-    max_size=3,
+    min_size=settings.checkpointer_pool_min_size,
+    max_size=settings.checkpointer_pool_max_size,
+    timeout=settings.checkpointer_pool_timeout,
+    max_idle=settings.checkpointer_pool_max_idle,
+    max_lifetime=settings.checkpointer_pool_max_lifetime,
     kwargs={
         "row_factory": dict_row
     }
@@ -51,6 +102,37 @@ checkpointer_pool = AsyncConnectionPool(
 print("created checkpointer pool")
 
 
+async def warm_up_user_db_pool():
+    '''The user-database engine opens db_pool_warmup connections before the first request so it doesn't pay the TLS handshakes to Neon'''
+    connections = [engine.connect() for _ in range(min(settings.db_pool_warmup, settings.db_pool_size))]
+    await asyncio.gather(*(connection.start() for connection in connections))
+    await asyncio.gather(*(connection.close() for connection in connections))
+
+
+async def open_checkpointer_pool(wait: bool = True):
+    '''Opens the checkpointer pool, with wait it returns once its min_size connections are open'''
+    if wait:
+        await checkpointer_pool.open(wait=True, timeout=settings.checkpointer_pool_timeout)
+    else:
+        await checkpointer_pool.open()
+
+
+def user_db_pool_stats() -> dict:
+    pool = engine.pool
+    return {"size": pool.size(), "in_use": pool.checkedout(), "idle": pool.checkedin(), "overflow": pool.overflow(), "waiting": TimedAsyncAdaptedQueuePool.waiting}
+
+
+def checkpointer_pool_stats() -> dict:
+    stats = checkpointer_pool.get_stats()
+    return {
+        "size": stats.get("pool_size", 0),
+        "in_use": stats.get("pool_size", 0) - stats.get("pool_available", 0),
+        "idle": stats.get("pool_available", 0),
+        "waiting": stats.get("requests_waiting", 0),
+        "timeouts": stats.get("requests_errors", 0)
+    }
+
+
 
 
 
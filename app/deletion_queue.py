@@ -0,0 +1,129 @@
+import asyncio
+import uuid
+from typing import List
+from sqlalchemy import text
+from .database import AsyncSessionLocal
+from .config import settings
+from . import metrics, checkpoint_store
+
+
+'''
+Deletes the checkpoints of closed threads off the critical path.
+When a thread is closed(MATCH_FOUND, replaced by /create-new-chat while active, or idle and closed by the reaper) a row is inserted in pending_checkpoint_deletion
+in the same statement that closes it, so the endpoint can return as soon as the session row is committed.
+The thread id is also handed to this in-process queue which deletes the checkpoints right away and then removes the row.
+A poller picks up the rows left behind(failed deletes, a crash or another worker) with FOR UPDATE SKIP LOCKED, pushing their
+next_attempt_at forward with an exponential backoff while it works on them, so nothing leaks and no two workers delete the same batch.
+'''
+
+CLAIM_DUE = text("""
+    UPDATE pending_checkpoint_deletion
+    SET attempts = attempts + 1,
+        next_attempt_at = now() + make_interval(secs => LEAST(:max_backoff, :base_backoff * power(2, attempts)))
+    WHERE thread_id IN (
+        SELECT thread_id FROM pending_checkpoint_deletion
+        WHERE next_attempt_at <= now()
+        ORDER BY next_attempt_at
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING thread_id
+""")
+
+REMOVE_DONE = text("DELETE FROM pending_checkpoint_deletion WHERE thread_id = ANY(CAST(:thread_ids AS uuid[]))")
+
+RECORD_ERROR = text("UPDATE pending_checkpoint_deletion SET last_error = :error WHERE thread_id = ANY(CAST(:thread_ids AS uuid[]))")
+
+FIRST_ATTEMPT_DELAY = "interval '1 minute'"     # the in-process queue gets the first try, the poller only picks rows older than this
+BASE_BACKOFF = 5.0      # seconds, doubled on every failed attempt
+MAX_BACKOFF = 600.0
+
+
+class DeletionQueue:
+
+    def __init__(self, poll_interval: float = 30.0, batch_size: int = 100, concurrency: int = 2):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.deleted = 0
+        self.failed = 0
+        self.tasks: List[asyncio.Task] = []
+
+    def enqueue(self, thread_id: str):
+        '''Call only after the pending_checkpoint_deletion row is committed'''
+        checkpoint_store.forget(thread_id)
+        self.queue.put_nowait(thread_id)
+
+    async def _process(self, thread_ids: List[str]) -> bool:
+        '''Deletes the checkpoints and then the pending rows. On failure the rows are left for the poller'''
+        uuid_thread_ids = [uuid.UUID(thread_id) for thread_id in thread_ids]
+        try:
+            await checkpoint_store.delete_threads(thread_ids, self.concurrency)
+        except Exception as e:
+            self.failed += len(thread_ids)
+            print("could not delete checkpoints, they will be retried:", e)
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(RECORD_ERROR, {"thread_ids": uuid_thread_ids, "error": str(e)[:500]})
+                    await db.commit()
+            except Exception:
+                pass
+            return False
+        async with AsyncSessionLocal() as db:
+            with metrics.USER_DB_SECONDS.time(operation="deletion_done"):
+                await db.execute(REMOVE_DONE, {"thread_ids": uuid_thread_ids})
+                await db.commit()
+        self.deleted += len(thread_ids)
+        return True
+
+    async def _drain(self):
+        while True:
+            thread_ids = [await self.queue.get()]
+            while len(thread_ids) < self.batch_size and not self.queue.empty():     # batches the closes that piled up meanwhile
+                thread_ids.append(self.queue.get_nowait())
+            try:
+                await self._process(thread_ids)
+            except Exception as e:
+                print("deletion queue failed, the poller will retry:", e)
+
+    async def poll_once(self) -> int:
+        '''Claims and processes the due pending rows, returns how many threads were processed'''
+        processed = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                with metrics.USER_DB_SECONDS.time(operation="deletion_claim"):
+                    rows = (await db.execute(CLAIM_DUE, {"batch_size": self.batch_size, "base_backoff": BASE_BACKOFF, "max_backoff": MAX_BACKOFF})).all()
+                    await db.commit()
+            if not rows:
+                return processed
+            await self._process([str(row.thread_id) for row in rows])
+            processed += len(rows)
+            if len(rows) < self.batch_size:
+                return processed
+
+    async def _poll(self):
+        while True:
+            try:
+                await self.poll_once()
+            except Exception as e:
+                print("deletion poller failed, retrying in the next interval:", e)
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._drain()), asyncio.create_task(self._poll())]
+
+    async def stop(self):
+        '''Unfinished deletions stay in the table and are picked up after the restart'''
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+
+deletion_queue = DeletionQueue(
+    poll_interval=settings.deletion_poll_interval,
+    batch_size=settings.deletion_batch_size,
+    concurrency=settings.reaper_concurrency
+)
@@ -0,0 +1,43 @@
+import os
+from functools import cached_property
+from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2
+
+
+'''
+Query embedding model of the process.
+chroma's DefaultEmbeddingFunction builds a new ONNXMiniLM_L6_V2(and so a new onnxruntime session) on every call, here one instance
+is kept for the whole process. It is the same all-MiniLM-L6-v2 model the collection was embedded with.
+
+onnxruntime sessions are not fork-safe, so with the multi-worker mode the parent only makes sure the model files are downloaded
+and every worker creates its own session on first use. The intra-op threads of the session can be limited so N workers don't
+each start a thread per core.
+'''
+
+
+class QueryEmbedder(ONNXMiniLM_L6_V2):
+
+    def __init__(self, intra_op_threads: int = 0):
+        super().__init__(preferred_providers=["CPUExecutionProvider"])
+        self.intra_op_threads = intra_op_threads
+
+    def download(self):
+        '''Downloads and verifies the model files without creating the session, safe to call before forking'''
+        self._download_model_if_not_exists()
+
+    @property
+    def is_loaded(self) -> bool:
+        return "model" in self.__dict__
+
+    @cached_property
+    def model(self):
+        so = self.ort.SessionOptions()
+        so.log_severity_level = 3
+        so.graph_optimization_level = self.ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.intra_op_threads > 0:
+            so.intra_op_num_threads = self.intra_op_threads
+            so.inter_op_num_threads = 1
+        return self.ort.InferenceSession(
+            os.path.join(self.DOWNLOAD_PATH, self.EXTRACTED_FOLDER_NAME, "model.onnx"),
+            providers=self._preferred_providers,
+            sess_options=so
+        )
@@ -0,0 +1,85 @@
+import asyncio
+import uuid
+from datetime import datetime
+from typing import Dict, Optional
+from zoneinfo import ZoneInfo
+from sqlalchemy import text
+from .database import AsyncSessionLocal
+from .config import settings
+from . import metrics
+
+
+'''
+Write-behind buffer for the thread_last_used_at heartbeat of the ChatSession rows.
+The column is only treated as a heartbeat(it is used by the time based cleanup), so /start and /resume don't wait on
+writing it: the timestamps are coalesced in memory(latest per session) and flushed by a background task started in the lifespan
+with one multi-row UPDATE per interval. The buffer is flushed once more on shutdown.
+'''
+
+FLUSH_STATEMENT = text("""
+    UPDATE chatsession AS c
+    SET thread_last_used_at = GREATEST(c.thread_last_used_at, v.last_used_at)
+    FROM unnest(CAST(:session_ids AS uuid[]), CAST(:last_used_at AS timestamptz[])) AS v(session_id, last_used_at)
+    WHERE c.session_id = v.session_id
+""")
+
+
+class HeartbeatBuffer:
+
+    def __init__(self, interval: float = 5.0):
+        self.interval = interval
+        self.pending: Dict[uuid.UUID, datetime] = {}
+        self.flushed = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def touch(self, session_id: uuid.UUID):
+        self.pending[session_id] = datetime.now(ZoneInfo("UTC"))
+
+    def _requeue(self, batch: Dict[uuid.UUID, datetime]):
+        '''Puts a failed batch back without overwriting newer heartbeats'''
+        for session_id, last_used_at in batch.items():
+            if session_id not in self.pending or self.pending[session_id] < last_used_at:
+                self.pending[session_id] = last_used_at
+
+    async def flush(self) -> int:
+        if not self.pending:
+            return 0
+        batch, self.pending = self.pending, {}
+        try:
+            async with AsyncSessionLocal() as db:
+                with metrics.USER_DB_SECONDS.time(operation="heartbeat_flush"):
+                    await db.execute(FLUSH_STATEMENT, {"session_ids": list(batch), "last_used_at": list(batch.values())})
+                    await db.commit()
+        except Exception:
+            self._requeue(batch)
+            raise
+        self.flushed += len(batch)
+        return len(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print("could not flush the heartbeats, retrying in the next interval:", e)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print("could not flush the heartbeats on shutdown:", e)
+
+
+buffer = HeartbeatBuffer(interval=settings.heartbeat_flush_interval)
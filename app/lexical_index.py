@@ -0,0 +1,146 @@
+import os
+import re
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+
+'''
+In-memory BM25 index over the NCO catalogue, fused with the vector search by reciprocal-rank fusion.
+MiniLM similarity alone misses exact titles of the Indian occupation vocabulary(e.g. "Dhobi", "Mistri", "Anganwadi Worker"),
+a lexical match on the titles brings them into the first retrieval so the analyzer needs IMPROVED_SEARCH less often.
+
+Every document is the final_title used for the embeddings(division, title, description) plus the occupation_title once more,
+so matches on the title weigh more than matches in the description. The rows are the rows of the CatalogueIndex.
+The postings are kept in CSR form: postings_docs[indptr[t]:indptr[t + 1]] are the rows containing term t and postings_weights
+holds their precomputed BM25 impact, so scoring a query is one vectorized add per query term.
+The arrays are cached in a .npz file next to the vector cache, keyed on the catalogue version.
+'''
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "into", "is", "it", "of", "on", "or",
+    "such", "the", "their", "to", "with", "etc", "other", "others",
+    "division", "title", "description"      # field labels of the documents and of the expander queries
+))
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):     # light plural folding, workers -> worker
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = 60) -> List[int]:
+    '''Fuses ranked lists of rows, score of a row is the sum of 1 / (k + rank) over the lists. Ties keep the order of the first list'''
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            scores[int(row)] = scores.get(int(row), 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda row: -scores[row])
+
+
+class LexicalIndex:
+
+    def __init__(self, cache_dir: Optional[Path] = None, k1: float = 1.2, b: float = 0.75):
+        self.cache_dir = cache_dir
+        self.k1 = k1
+        self.b = b
+        self.version = None
+        self.vocabulary: Dict[str, int] = {}
+        self.indptr: Optional[np.ndarray] = None
+        self.postings_docs: Optional[np.ndarray] = None
+        self.postings_weights: Optional[np.ndarray] = None
+        self.n_docs = 0
+        self.is_loaded = False
+
+    def _cache_file(self, name: str) -> Optional[Path]:
+        return self.cache_dir / f"{name}.bm25.npz" if self.cache_dir is not None else None
+
+    def _load_from_cache(self, cache_file: Optional[Path], n_docs: int) -> bool:
+        if cache_file is None or not cache_file.exists():
+            return False
+        with np.load(cache_file, allow_pickle=False) as data:
+            if str(data["version"]) != self.version or int(data["n_docs"]) != n_docs or float(data["k1"]) != self.k1 or float(data["b"]) != self.b:
+                return False
+            self.vocabulary = {term: term_id for term_id, term in enumerate(data["terms"].tolist())}
+            self.indptr = data["indptr"]
+            self.postings_docs = data["postings_docs"]
+            self.postings_weights = data["postings_weights"]
+        return True
+
+    def _build(self, documents: List[str], metadatas: List[dict]):
+        term_frequencies: List[Dict[int, int]] = []
+        for document, metadata in zip(documents, metadatas):
+            frequencies: Dict[int, int] = {}
+            for token in tokenize(f"{document or ''} {(metadata or {}).get('occupation_title') or ''}"):
+                term_id = self.vocabulary.setdefault(token, len(self.vocabulary))
+                frequencies[term_id] = frequencies.get(term_id, 0) + 1
+            term_frequencies.append(frequencies)
+
+        doc_lengths = np.array([sum(frequencies.values()) for frequencies in term_frequencies], dtype=np.float32)
+        length_norm = self.k1 * (1 - self.b + self.b * doc_lengths / max(float(doc_lengths.mean()) if doc_lengths.size else 0.0, 1.0))
+        postings: List[List[int]] = [[] for _ in self.vocabulary]
+        tfs: List[List[int]] = [[] for _ in self.vocabulary]
+        for row, frequencies in enumerate(term_frequencies):
+            for term_id, tf in frequencies.items():
+                postings[term_id].append(row)
+                tfs[term_id].append(tf)
+
+        document_frequencies = np.array([len(rows) for rows in postings], dtype=np.float32)
+        idf = np.log(1.0 + (len(documents) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        self.indptr = np.zeros(len(postings) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(document_frequencies.astype(np.int64))
+        self.postings_docs = np.fromiter((row for rows in postings for row in rows), dtype=np.int32, count=int(self.indptr[-1]))
+        tf = np.fromiter((count for term_tfs in tfs for count in term_tfs), dtype=np.float32, count=int(self.indptr[-1]))
+        term_of_posting = np.repeat(np.arange(len(postings)), document_frequencies.astype(np.int64))
+        self.postings_weights = (idf[term_of_posting] * tf * (self.k1 + 1) / (tf + length_norm[self.postings_docs])).astype(np.float32)
+
+    def load(self, name: str, version: str, documents: List[str], metadatas: List[dict]):
+        '''Blocking. Builds(or loads the cached) postings for the rows of the catalogue index'''
+        self.version = version
+        self.n_docs = len(documents)
+        self.vocabulary = {}
+        cache_file = self._cache_file(name)
+        if not self._load_from_cache(cache_file, self.n_docs):
+            self._build(documents, metadatas)
+            if cache_file is not None:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                temp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")     # every worker may rebuild it, the last one wins
+                with open(temp_file, "wb") as f:
+                    np.savez(
+                        f,
+                        version=np.array(version),
+                        n_docs=np.array(self.n_docs),
+                        k1=np.array(self.k1),
+                        b=np.array(self.b),
+                        terms=np.array(list(self.vocabulary)),
+                        indptr=self.indptr,
+                        postings_docs=self.postings_docs,
+                        postings_weights=self.postings_weights
+                    )
+                os.replace(temp_file, cache_file)
+        self.is_loaded = True
+        print(f"loaded lexical index with {len(self.vocabulary)} terms and {self.postings_docs.shape[0]} postings")
+
+    def scores(self, query_text: str) -> np.ndarray:
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term_id in {self.vocabulary[token] for token in tokenize(query_text) if token in self.vocabulary}:
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            scores[self.postings_docs[start:end]] += self.postings_weights[start:end]      # a row appears once per term
+        return scores
+
+    def top_k(self, query_text: str, n_results: int, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        '''Rows with the best BM25 scores, only rows matching at least one query term(and among rows if given)'''
+        scores = self.scores(query_text)
+        matched = np.flatnonzero(scores > 0)
+        if rows is not None:
+            matched = matched[np.isin(matched, rows, assume_unique=True)]
+        if matched.size > n_results:
+            matched = matched[np.argpartition(-scores[matched], n_results - 1)[:n_results]]
+        return matched[np.argsort(-scores[matched], kind="stable")]
@@ -1,29 +1,86 @@
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from . import models
-from .database import engine, checkpointer_pool
-from .routers import create_session, create_chat, start_chat, resume_chat
+from . import models, utils, metrics, heartbeat, reaper, checkpoint_store
+from .deletion_queue import deletion_queue
+from .startup import startup
+from .database import engine, checkpointer_pool, warm_up_user_db_pool, open_checkpointer_pool, user_db_pool_stats, checkpointer_pool_stats
+from .src import llm_dispatcher, graph
+from .routers import create_session, create_chat, start_chat, resume_chat, batch
 from .config import settings
 from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
 from contextlib import asynccontextmanager
+import asyncio
 
 
 async def create_table_if_not_exists():
     async with engine.connect() as conn:
         print("connected to the user database")
         await conn.run_sync(models.Base.metadata.create_all)
-        
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+
+
+async def warm_up_user_database():
     print("trying to create tables if not exists")
     await create_table_if_not_exists()
-    await checkpointer_pool.open()
+    if settings.pool_warmup:
+        await warm_up_user_db_pool()
+
+
+async def warm_up_checkpointer():
+    await open_checkpointer_pool(wait=settings.pool_warmup)
     async with checkpointer_pool.connection() as conn:
         # We create a temporary saver just for the setup() call
         temp_saver = AsyncPostgresSaver(conn)
         await temp_saver.setup()
+    graph.get_graph()
+
+
+async def load_catalogue_index():
+    if settings.vector_index_enabled and not utils.catalogue_index.is_loaded:      # already loaded in the parent with gunicorn.conf.py
+        await asyncio.to_thread(utils.load_catalogue_index)
+
+
+async def load_embedding_model():
+    embedder = utils.get_query_embedder()
+    await asyncio.to_thread(embedder, ["warm up"])      # downloads the model if needed and creates the onnxruntime session
+
+
+async def load_query_cache():
+    if not utils.query_embedding_cache.entries:
+        await asyncio.to_thread(utils.query_embedding_cache.load)
+
+
+async def warm_up():
+    await startup.run(
+        startup.phase("user_database", warm_up_user_database),
+        startup.phase("checkpointer", warm_up_checkpointer),
+        startup.phase("llm", lambda: asyncio.to_thread(graph.structured_llms)),
+        startup.phase("catalogue_index", load_catalogue_index, required=False),       # falls back to chroma
+        startup.phase("embedding_model", load_embedding_model, required=False),
+        startup.phase("query_cache", load_query_cache, required=False)
+    )
+    if settings.heartbeat_buffer_enabled:
+        heartbeat.buffer.start()
+    deletion_queue.start()
+    if settings.reaper_enabled:
+        reaper.reaper.start()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.lazy_startup:
+        startup.start(warm_up())
+    else:
+        await warm_up()
     yield
     
+    await startup.stop()
+    await reaper.reaper.stop()
+    await deletion_queue.stop()     # unfinished deletions stay in pending_checkpoint_deletion
+    await heartbeat.buffer.stop()       # flushes the remaining heartbeats
+    print("query embeddings cache:", utils.query_embedding_cache.stats())
+    print("llm dispatcher:", llm_dispatcher.dispatcher.stats())
+    await asyncio.to_thread(utils.query_embedding_cache.save)
     await checkpointer_pool.close()
     
 
@@ -33,10 +90,47 @@ app.include_router(create_session.router)
 app.include_router(create_chat.router)
 app.include_router(start_chat.router)
 app.include_router(resume_chat.router)
+app.include_router(batch.router)
         
 @app.get("/")
 def read_root():    # This is just the route which is used to wake up the API on platforms like render free teir
     return {"message": "Welcome to the NCO Classification Chatbot API"}
+
+
+@app.get("/healthz", include_in_schema=False)
+def healthz():      # liveness, the process is up(doesn't wait for the startup)
+    return {"status": "ok"}
+
+
+@app.get("/readyz", include_in_schema=False)
+def readyz():       # readiness, the startup phases(pools, checkpointer, models) have finished
+    status = startup.status()
+    if not startup.ready or checkpointer_pool.closed:
+        return JSONResponse(status_code=503, content=status)
+    return status
+
+
+
+metrics.registry.register(metrics.Gauge("llm_queue_depth", "Llm calls waiting in the dispatcher queue", lambda: llm_dispatcher.dispatcher.stats()["queue_depth"]))
+metrics.registry.register(metrics.Gauge("llm_calls_running", "Llm calls in flight", lambda: llm_dispatcher.dispatcher.running))
+metrics.registry.register(metrics.Gauge("llm_calls_coalesced_total", "Llm calls served by an identical call already in flight", lambda: llm_dispatcher.dispatcher.coalesced))
+metrics.registry.register(metrics.Gauge("query_embedding_cache_hits_total", "Query embedding cache hits", lambda: utils.query_embedding_cache.hits))
+metrics.registry.register(metrics.Gauge("query_embedding_cache_misses_total", "Query embedding cache misses", lambda: utils.query_embedding_cache.misses))
+for pool_name, pool_stats in (("user_db", user_db_pool_stats), ("checkpointer", checkpointer_pool_stats)):
+    for stat in ("size", "in_use", "idle", "waiting"):
+        metrics.registry.register(metrics.Gauge(f"{pool_name}_pool_{stat}", f"Connections of the {pool_name} pool: {stat}", lambda pool_stats=pool_stats, stat=stat: pool_stats()[stat]))
+metrics.registry.register(metrics.Gauge("known_threads_hits_total", "Thread existence checks answered from the in-process cache", lambda: checkpoint_store.known_threads.hits))
+metrics.registry.register(metrics.Gauge("checkpoint_deletion_queue_depth", "Closed threads waiting for their checkpoints to be deleted in this worker", lambda: deletion_queue.queue.qsize()))
+metrics.registry.register(metrics.Gauge("checkpoint_deletions_failed_total", "Checkpoint deletions which failed and were left for retry", lambda: deletion_queue.failed))
+metrics.registry.register(metrics.Gauge("heartbeat_pending", "Session heartbeats waiting to be flushed", lambda: len(heartbeat.buffer.pending)))
+metrics.registry.register(metrics.Gauge("startup_seconds", "Time the startup phases took", lambda: startup.total_seconds))
+metrics.registry.register(metrics.Gauge("ready", "1 once the startup has finished", lambda: int(startup.ready)))
+metrics.registry.register(metrics.Gauge("response_cache_hits_total", "Semantic response cache hits", lambda: graph.response_cache.hits))
+metrics.registry.register(metrics.Gauge("response_cache_misses_total", "Semantic response cache misses", lambda: graph.response_cache.misses))
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def read_metrics():    # scraped by prometheus
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
              
 app.add_middleware(
     CORSMiddleware,
@@ -45,3 +139,4 @@ app.add_middleware(
     allow_methods = ["*"],
     allow_headers = ["*"]
 )
+app.add_middleware(metrics.MetricsMiddleware)
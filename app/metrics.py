@@ -0,0 +1,185 @@
+import bisect
+import time
+import functools
+import inspect
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+
+
+'''
+Minimal Prometheus-style metrics used to see where the time of a chat turn goes.
+Metrics are kept in process and rendered in the Prometheus text format on the /metrics endpoint.
+With multiple workers every worker exposes its own numbers.
+'''
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _label_text(labelnames: Tuple[str, ...], labelvalues: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_label_text(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+
+    '''Gauge whose value is read from a callback when the metrics are scraped'''
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self) -> list:
+        try:
+            value = float(self.callback())
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], list] = {}     # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = _label_text(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _label_text(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.register(Histogram("http_request_duration_seconds", "Wall time of http requests till the last byte is sent", ("method", "route", "status")))
+USER_DB_SECONDS = registry.register(Histogram("user_db_seconds", "Wall time of user-database operations(session row lock, heartbeat, close)", ("operation",)))
+CHECKPOINTER_SECONDS = registry.register(Histogram("checkpointer_seconds", "Wall time of checkpointer operations", ("operation",)))
+GRAPH_NODE_SECONDS = registry.register(Histogram("graph_node_seconds", "Wall time of each graph node", ("node",)))
+LLM_CALL_SECONDS = registry.register(Histogram("llm_call_seconds", "Wall time of llm calls excluding the time spent in the dispatcher queue", ("name",)))
+LLM_QUEUE_WAIT_SECONDS = registry.register(Histogram("llm_queue_wait_seconds", "Time llm calls waited in the dispatcher queue", ("priority",)))
+LLM_PROMPT_TOKENS = registry.register(Histogram("llm_prompt_tokens", "Prompt tokens per llm call", ("name",), buckets=TOKEN_BUCKETS))
+LLM_COMPLETION_TOKENS = registry.register(Histogram("llm_completion_tokens", "Completion tokens per llm call", ("name",), buckets=TOKEN_BUCKETS))
+LLM_ERRORS = registry.register(Counter("llm_errors_total", "Failed llm calls", ("name",)))
+VECTOR_SEARCH_SECONDS = registry.register(Histogram("vector_search_seconds", "Wall time of vector searches", ("backend",)))
+PROMPT_TOKENS = registry.register(Histogram("prompt_estimated_tokens", "Estimated tokens of the static(system) and dynamic(human) parts of the prompts", ("prompt", "part"), buckets=TOKEN_BUCKETS))
+REAPER_RECLAIMED = registry.register(Counter("reaper_reclaimed_total", "Sessions closed, threads and checkpoint rows deleted by the reaper", ("kind",)))
+POOL_ACQUIRE_SECONDS = registry.register(Histogram("db_pool_acquire_seconds", "Time waited to get a connection from the pool", ("pool",)))
+POOL_TIMEOUTS = registry.register(Counter("db_pool_timeouts_total", "Connection requests which timed out waiting for the pool", ("pool",)))
+SPECULATIVE_HITS = registry.register(Counter("speculative_search_hits_total", "Codes found by the speculative search on the raw message, new ones were not in the expander query results", ("kind",)))
+DIVISION_SEARCHES = registry.register(Counter("division_searches_total", "Searches with division_retrieval, partition ones scanned only the division of the query, the others fell back to the whole catalogue", ("outcome",)))
+EMBEDDING_SECONDS = registry.register(Histogram("query_embedding_seconds", "Wall time of query embeddings computed by the model(cache misses)"))
+
+
+def instrument_node(name: str, node: Callable) -> Callable:
+
+    '''Wraps a graph node(sync or async) so that its wall time is recorded'''
+
+    if inspect.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def async_wrapper(state):
+            with GRAPH_NODE_SECONDS.time(node=name):
+                return await node(state)
+        return async_wrapper
+
+    @functools.wraps(node)
+    def sync_wrapper(state):
+        with GRAPH_NODE_SECONDS.time(node=name):
+            return node(state)
+    return sync_wrapper
+
+
+class MetricsMiddleware:
+
+    '''ASGI middleware, so the time of streaming responses is measured till the last chunk is sent'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")     # route template, so that ids in paths don't blow up the labels
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=scope["method"], route=route_path, status=status_code)
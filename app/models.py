@@ -16,3 +16,12 @@ class ChatSession(Base):
     thread_closed_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
     thread_last_used_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=text("now()"), nullable=False)   # It is only treated as a heartbeat not proof of success
     
+
+
+class PendingCheckpointDeletion(Base):
+    __tablename__="pending_checkpoint_deletion"
+    thread_id: Mapped[uuid.UUID] = mapped_column(primary_key=True)     # thread whose checkpoints have to be deleted, inserted in the same transaction which closes the thread
+    enqueued_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=text("now()"), nullable=False)
+    next_attempt_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=text("now()"), nullable=False, index=True)
+    attempts: Mapped[int] = mapped_column(server_default=text("0"), nullable=False)
+    last_error: Mapped[str | None] = mapped_column(nullable=True)
@@ -0,0 +1,116 @@
+import asyncio
+import uuid
+from typing import List, Optional
+from sqlalchemy import text
+from .database import AsyncSessionLocal
+from .config import settings
+from .deletion_queue import REMOVE_DONE, FIRST_ATTEMPT_DELAY
+from . import metrics, heartbeat, checkpoint_store
+
+
+'''
+Time based cleanup of abandoned threads.
+A thread whose session has not been used(thread_last_used_at) for thread_idle_ttl seconds is closed in the user-database
+and its checkpoints are deleted, so the langgraph checkpoint tables don't grow without bound.
+The reaper is driven by the session table only, the checkpoint tables are never scanned: every thread is closed by a statement
+which also inserts its pending_checkpoint_deletion row(MATCH_FOUND, /create-new-chat, or the reaper here), so a thread whose
+session moved on always has its deletion recorded, and the deletion queue's poller retries whatever the reaper could not delete.
+
+Sessions are closed in batches with FOR UPDATE SKIP LOCKED so several workers can run the reaper at the same time,
+and checkpoints are deleted in chunks of thread ids with a bounded number of concurrent deletes.
+'''
+
+CLOSE_IDLE_SESSIONS = text(f"""
+    WITH closed AS (
+        UPDATE chatsession SET is_active = false, thread_closed_at = now()
+        WHERE session_id IN (
+            SELECT session_id FROM chatsession
+            WHERE is_active AND thread_last_used_at < now() - make_interval(secs => :ttl)
+            ORDER BY thread_last_used_at
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING thread_id
+    ), queued AS (
+        INSERT INTO pending_checkpoint_deletion (thread_id, next_attempt_at)
+        SELECT thread_id, now() + {FIRST_ATTEMPT_DELAY} FROM closed
+        ON CONFLICT DO NOTHING
+    )
+    SELECT thread_id FROM closed
+""")        # the deletion is recorded with the close, a crash before the delete doesn't leak the checkpoints
+
+
+class Reaper:
+
+    def __init__(self, ttl: float, interval: float, batch_size: int = 500, concurrency: int = 2):
+        self.ttl = float(ttl)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.task: Optional[asyncio.Task] = None
+
+    async def close_idle_sessions(self) -> List[str]:
+        '''Closes one batch of idle sessions and records the deletion of their checkpoints, returns their thread ids'''
+        async with AsyncSessionLocal() as db:
+            with metrics.USER_DB_SECONDS.time(operation="reaper_close"):
+                rows = (await db.execute(CLOSE_IDLE_SESSIONS, {"ttl": self.ttl, "batch_size": self.batch_size})).all()
+                await db.commit()
+        return [str(row.thread_id) for row in rows]
+
+    async def delete_threads(self, thread_ids: List[str]) -> int:
+        '''Deletes the checkpoints and then the pending rows, on failure the rows are left for the deletion queue's poller'''
+        deleted = await checkpoint_store.delete_threads(thread_ids, self.concurrency)
+        async with AsyncSessionLocal() as db:
+            with metrics.USER_DB_SECONDS.time(operation="deletion_done"):
+                await db.execute(REMOVE_DONE, {"thread_ids": [uuid.UUID(thread_id) for thread_id in thread_ids]})
+                await db.commit()
+        return deleted
+
+    async def run_once(self) -> dict:
+        report = {"sessions_closed": 0, "threads_deleted": 0, "checkpoint_rows_deleted": 0}
+        if settings.heartbeat_buffer_enabled:
+            await heartbeat.buffer.flush()      # so that sessions in use are not seen as idle
+
+        while True:
+            thread_ids = await self.close_idle_sessions()
+            if thread_ids:
+                report["sessions_closed"] += len(thread_ids)
+                report["threads_deleted"] += len(thread_ids)
+                report["checkpoint_rows_deleted"] += await self.delete_threads(thread_ids)
+            if len(thread_ids) < self.batch_size:
+                break
+
+        for kind, count in report.items():
+            metrics.REAPER_RECLAIMED.inc(count, kind=kind)
+        return report
+
+    async def _run(self):
+        while True:
+            try:
+                report = await self.run_once()
+                if any(report.values()):
+                    print("reaper:", report)
+            except Exception as e:
+                print("reaper run failed, retrying in the next interval:", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+reaper = Reaper(
+    ttl=settings.thread_idle_ttl,
+    interval=settings.reaper_interval,
+    batch_size=settings.reaper_batch_size,
+    concurrency=settings.reaper_concurrency
+)
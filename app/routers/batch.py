@@ -0,0 +1,53 @@
+import hmac
+import json
+from fastapi import APIRouter, status, HTTPException, Header, Request, Query
+from fastapi.responses import StreamingResponse
+from .. import schemas, batch
+from ..config import settings
+
+
+router=APIRouter(
+    tags=["Batch classification"]
+)
+
+
+def check_api_key(x_api_key: str | None):
+    if not settings.batch_api_key or x_api_key is None or not hmac.compare_digest(x_api_key, settings.batch_api_key):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=schemas.INVALID_API_KEY_ERROR.model_dump())
+
+
+def invalid_batch_error(message: str) -> dict:
+    return schemas.ErrorDetail(detail="INVALID_BATCH", error_message=message).model_dump()
+
+
+@router.post("/batch/classify", status_code=status.HTTP_200_OK)
+async def classify_batch(
+    request: Request,
+    start_at: int = Query(default=0, ge=0),
+    concurrency: int | None = Query(default=None, ge=1),
+    input_format: str | None = Query(default=None, alias="format"),
+    x_api_key: str | None = Header(default=None)
+):
+
+    '''
+    Classifies a csv(with a header) or ndjson body of job descriptions without the human step.
+    One json line per row is streamed back in the input order, send the batch again with start_at = lines received to resume it.
+    '''
+
+    check_api_key(x_api_key)
+    if input_format is None:
+        input_format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    try:
+        rows = batch.parse_rows((await request.body()).decode("utf-8"), input_format)
+    except (batch.BatchInputError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=invalid_batch_error(str(e)))
+    if len(rows) > settings.batch_max_rows:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=invalid_batch_error(f"At most {settings.batch_max_rows} rows per batch."))
+
+    concurrency = min(concurrency or settings.batch_concurrency, settings.batch_concurrency)
+
+    async def result_lines():
+        async for result in batch.run_batch(rows, concurrency, start_at):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(result_lines(), media_type="application/x-ndjson", headers={"X-Batch-Rows": str(len(rows))})
@@ -1,10 +1,6 @@
 from fastapi import APIRouter, status, HTTPException, Depends
-from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-import uuid
-from datetime import datetime
-from zoneinfo import ZoneInfo
-from .. import models, schemas, utils, auth
+from .. import schemas, utils, auth, session_service
 from ..database import get_db
 
 
@@ -19,33 +15,8 @@ async def new_chat(session_id: str = Depends(auth.get_session_id), db: AsyncSess
     uuid_session_id = utils.parse_uuid(session_id)
     if uuid_session_id is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=schemas.INVALID_SESSION_ID_ERROR.model_dump())
-    try:
-        stmt = select(models.ChatSession).where(models.ChatSession.session_id == uuid_session_id).with_for_update()
-        session_tuple = await db.execute(stmt)
-        session = session_tuple.scalar_one_or_none()
-    except Exception as e:
-        print("database connection problem:", e)
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=schemas.USER_DATABASE_ERROR)
-    if not session:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=schemas.INVALID_SESSION_ID_ERROR.model_dump())
+    new_thread_id, old_thread_id, was_active = await session_service.rotate_thread(db, uuid_session_id)
+    # If the old thread was active its checkpoints(if any) are deleted in the background(app/deletion_queue.py)
+    # If the session is not active then that thread will be automatically deleted from checkpoints by time based cleanup(app/reaper.py)
 
-    old_thread_id=str(session.thread_id)   
-    was_active=session.is_active    
-    utc_now=datetime.now(ZoneInfo("UTC"))
-    session.thread_id=uuid.uuid4()
-    session.is_active=True
-    session.thread_created_at=utc_now
-    session.thread_last_used_at=utc_now
-    
-    try:   
-        await db.commit()
-        checkpoints = await utils.checkpointer.aget_tuple({"configurable": {"thread_id": old_thread_id}})
-        if checkpoints is not None and was_active:          # If the old thread exists in checkpoints and was active then that old thread should be deleted
-                                   #If the thread exists and the session is not active then that thread will be automatically deleted from checkpoints by time based cleanup
-            await utils.checkpointer.adelete_thread(old_thread_id)
-    except:
-        await db.rollback()
-        print("connection problem")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=schemas.DATABASE_ERROR.model_dump())
-    
-    return {"thread_id": str(session.thread_id)}    
\ No newline at end of file
+    return {"thread_id": str(new_thread_id)}
@@ -37,7 +37,7 @@ class ChatResponse(BaseModel):
 
 
 class ErrorDetail(BaseModel):
-    detail: Literal["INVALID_SESSION_ID", "INVALID_THREAD_ID", "CLOSED_THREAD", "THREAD_ID_NOT_FOUND", "THREAD_ID_ALREADY_EXISTS", "DATABASE_ERROR", "MISSING_HEADER"]
+    detail: Literal["INVALID_SESSION_ID", "INVALID_THREAD_ID", "CLOSED_THREAD", "THREAD_ID_NOT_FOUND", "THREAD_ID_ALREADY_EXISTS", "DATABASE_ERROR", "MISSING_HEADER", "INVALID_API_KEY", "INVALID_BATCH"]
     error_message: str
     class Config:
         from_attributes = True
@@ -65,6 +65,11 @@ START_THREAD_EXISTS_ERROR=ErrorDetail(                               #raised whe
     detail = "THREAD_ID_ALREADY_EXISTS", error_message = "The thread to be started already exists in checkpoints. Create a new chat."
 )
 
+#Batch Related Errors
+INVALID_API_KEY_ERROR=ErrorDetail(                                   #raised when the X-Api-Key header doesn't match batch_api_key(or no key is configured)
+    detail = "INVALID_API_KEY", error_message = "A valid X-Api-Key header is needed for batch classification."
+)
+
 # Internal Server Errors
 USER_DATABASE_ERROR=ErrorDetail(
     detail = "DATABASE_ERROR", error_message = "There is some backend problem with user database. Please try after some time."
@@ -0,0 +1,158 @@
+from fastapi import HTTPException, status
+from sqlalchemy import select, update, func, literal_column
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+import uuid
+from . import models, schemas, utils, metrics, heartbeat
+from .deletion_queue import deletion_queue, FIRST_ATTEMPT_DELAY
+from .config import settings
+
+
+'''
+Session-state helpers shared by the chat routers (/create-new-chat, /start, /resume and their streaming variants).
+Every write is a single statement(UPDATE ... RETURNING) and a commit, so a chat turn makes as few user-database round trips as possible.
+With the heartbeat buffer the validation of a turn is a SELECT and a commit instead, and thread_last_used_at is written later in bulk.
+The ChatSession row in the user-database is the source of truth for whether a thread can be used.
+'''
+
+
+def parse_ids(session_id: str, thread_id: str):
+    uuid_session_id = utils.parse_uuid(session_id)
+    uuid_thread_id = utils.parse_uuid(thread_id)
+    if uuid_session_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=schemas.INVALID_SESSION_ID_ERROR.model_dump())
+    if uuid_thread_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=schemas.INVALID_THREAD_ID_ERROR.model_dump())
+    return uuid_session_id, uuid_thread_id
+
+
+def _session_error(row, uuid_thread_id: uuid.UUID) -> HTTPException:
+    '''Works out why the conditional update matched no row, only runs on the error path'''
+    if row is None:
+        return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=schemas.INVALID_SESSION_ID_ERROR.model_dump())
+    if row.thread_id != uuid_thread_id:
+        return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=schemas.INVALID_THREAD_ID_ERROR.model_dump())
+    return HTTPException(status_code=status.HTTP_409_CONFLICT, detail=schemas.CLOSED_THREAD_ERROR.model_dump())
+
+
+async def _read_session(db: AsyncSession, uuid_session_id: uuid.UUID):
+    stmt = select(models.ChatSession.thread_id, models.ChatSession.is_active).where(models.ChatSession.session_id == uuid_session_id)
+    with metrics.USER_DB_SECONDS.time(operation="read_session"):
+        return (await db.execute(stmt)).one_or_none()
+
+
+async def _execute_and_commit(db: AsyncSession, stmt, operation: str):
+    '''Runs a single statement with RETURNING and commits it, returns the returned row'''
+    try:
+        with metrics.USER_DB_SECONDS.time(operation=operation):
+            row = (await db.execute(stmt)).one_or_none()
+            await db.commit()
+    except Exception as e:
+        await db.rollback()
+        print("database connection problem:", e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=schemas.USER_DATABASE_ERROR.model_dump())
+    return row
+
+
+async def validate_and_touch(db: AsyncSession, uuid_session_id: uuid.UUID, uuid_thread_id: uuid.UUID):
+
+    '''
+    Validates that the thread belongs to the session and is active and updates the heartbeat(thread_last_used_at).
+    With the heartbeat buffer it is a SELECT and a COMMIT(which only ends the read transaction) and the heartbeat is written later in bulk,
+    otherwise a single UPDATE ... RETURNING.
+    The session is read again only when the update matched no row, to return the right error.
+    '''
+
+    if settings.heartbeat_buffer_enabled:
+        try:
+            row = await _read_session(db, uuid_session_id)
+            await db.commit()       # ends the read transaction so the connection goes back to the pool while the graph runs
+        except Exception as e:
+            await db.rollback()
+            print("database connection problem:", e)
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=schemas.USER_DATABASE_ERROR.model_dump())
+        if row is None or row.thread_id != uuid_thread_id or not row.is_active:
+            raise _session_error(row, uuid_thread_id)
+        heartbeat.buffer.touch(uuid_session_id)
+        return
+
+    stmt = (
+        update(models.ChatSession)
+        .where(
+            models.ChatSession.session_id == uuid_session_id,
+            models.ChatSession.thread_id == uuid_thread_id,
+            models.ChatSession.is_active.is_(True)
+        )
+        .values(thread_last_used_at=func.now())
+        .returning(models.ChatSession.session_id)
+    )
+    if await _execute_and_commit(db, stmt, "validate_touch") is None:
+        raise _session_error(await _read_session(db, uuid_session_id), uuid_thread_id)
+
+
+def _queue_deletion(closed):
+    '''INSERT of the pending checkpoint deletion for the thread ids returned by the closing statement(used as a CTE)'''
+    return (
+        insert(models.PendingCheckpointDeletion)
+        .from_select(["thread_id", "next_attempt_at"], select(closed.c.thread_id, literal_column(f"now() + {FIRST_ATTEMPT_DELAY}")))
+        .on_conflict_do_nothing()
+        .cte("queued")
+    )
+
+
+async def rotate_thread(db: AsyncSession, uuid_session_id: uuid.UUID):
+
+    '''
+    Replaces the thread of the session with a new active one in a single UPDATE ... FROM(SELECT ... FOR UPDATE) RETURNING,
+    so the old thread id and whether it was active come back in the same round trip. If the old thread was active its
+    checkpoint deletion is queued in the same statement. Returns (new_thread_id, old_thread_id, was_active).
+    '''
+
+    new_thread_id = uuid.uuid4()
+    old = (
+        select(models.ChatSession.session_id, models.ChatSession.thread_id, models.ChatSession.is_active)
+        .where(models.ChatSession.session_id == uuid_session_id)
+        .with_for_update()
+        .subquery("old")
+    )
+    rotated = (
+        update(models.ChatSession)
+        .where(models.ChatSession.session_id == old.c.session_id)
+        .values(thread_id=new_thread_id, is_active=True, thread_created_at=func.now(), thread_last_used_at=func.now(), thread_closed_at=None)
+        .returning(old.c.thread_id, old.c.is_active)
+        .cte("rotated")
+    )
+    stmt = select(rotated.c.thread_id, rotated.c.is_active).add_cte(_queue_deletion(select(rotated.c.thread_id).where(rotated.c.is_active).subquery()))
+    row = await _execute_and_commit(db, stmt, "rotate_thread")
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=schemas.INVALID_SESSION_ID_ERROR.model_dump())
+    if row.is_active:
+        deletion_queue.enqueue(str(row.thread_id))
+    return new_thread_id, str(row.thread_id), row.is_active
+
+
+async def close_matched_thread(db: AsyncSession, uuid_session_id: uuid.UUID, thread_id: str):
+
+    '''
+    Closes the thread after MATCH_FOUND with a single conditional update, which also queues the deletion of its checkpoints
+    as the chat can't be resumed anymore. The checkpoints are deleted in the background(app/deletion_queue.py).
+    The update only matches while the thread is still the active thread of the session, so a thread is never closed twice.
+    '''
+
+    closed = (
+        update(models.ChatSession)
+        .where(
+            models.ChatSession.session_id == uuid_session_id,
+            models.ChatSession.thread_id == uuid.UUID(thread_id),
+            models.ChatSession.is_active.is_(True)
+        )
+        .values(is_active=False, thread_closed_at=func.now())
+        .returning(models.ChatSession.thread_id)
+        .cte("closed")
+    )
+    stmt = select(closed.c.thread_id).add_cte(_queue_deletion(closed))
+    if await _execute_and_commit(db, stmt, "close_thread") is None:
+        if await _read_session(db, uuid_session_id) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=schemas.INVALID_SESSION_ID_ERROR.model_dump())
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=schemas.CLOSED_THREAD_ERROR.model_dump())
+    deletion_queue.enqueue(thread_id)
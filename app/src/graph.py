@@ -1,37 +1,103 @@
 from langgraph.graph import StateGraph
 from langgraph.types import interrupt
+from langgraph.config import get_config
 from typing import TypedDict, List, Annotated, Optional, Any
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 from langgraph.graph.message import add_messages
 from langgraph.constants import END
 from pydantic import Field
-from .prompts import expander_prompt, analyzer_prompt
+from .prompts import prompt_builder
 from . import schemas
-from .. import utils
+from .response_cache import ResponseCache
+from .llm_dispatcher import dispatcher, PRIORITY_RESUME, PRIORITY_START, PRIORITY_BATCH
+from .. import utils, metrics
+from ..config import settings
 import uuid
+import asyncio
 from langgraph.types import Command
 
 
-llm_expander=utils.llm.with_structured_output(schemas.EXPANDER_OUTPUT_JSON_SCHEMA, method="json_mode")
-llm_analyzer=utils.llm.with_structured_output(schemas.ANALYZER_OUTPUT_JSON_SCHEMA, method="json_mode")
+llm_expander=None       # structured_llms(), created with the llm on first use
+llm_analyzer=None
+response_cache=ResponseCache(
+    threshold=settings.response_cache_threshold,
+    ttl=settings.response_cache_ttl,
+    max_size=settings.response_cache_size
+)
 
 
 class State(TypedDict):
     messages: Annotated[List[BaseMessage], add_messages]
     expander_analysis: Annotated[Optional[dict], Field(description="This stores the analysis done by expander")]
-    retrieved_results: Annotated[Any, Field(description="This stores the results retrieved after semantic search on the search_query sent by node1(expander_node)")]
+    retrieved_results: Annotated[Any, Field(description="This stores the codes and distances of the results retrieved after semantic search on the search_query sent by node1(expander_node)")]
     analyzer_response: Annotated[Optional[dict], Field(description="This stores the result of analysis done by the analyzer node")]
     improved_search: Annotated[bool, Field(description="This is an indicator for retrieval_node used to indicate whether the query has come from analyzer or not")]=False
     improved_search_count: Annotated[int, Field(description="This tells us if improved_search has been used before or not by Analyzer.")]=1
     
+def structured_llms():
+    '''Raw message is kept for token usage, dispatcher returns the parsed output'''
+    global llm_expander, llm_analyzer
+    if llm_expander is None:
+        llm = utils.get_llm()
+        llm_expander=llm.with_structured_output(schemas.EXPANDER_OUTPUT_JSON_SCHEMA, method="json_mode", include_raw=True)
+        llm_analyzer=llm.with_structured_output(schemas.ANALYZER_OUTPUT_JSON_SCHEMA, method="json_mode", include_raw=True)
+    return llm_expander, llm_analyzer
+
+
+def is_first_turn(state: State) -> bool:
+    return sum(isinstance(msg, HumanMessage) for msg in state['messages']) == 1
+
+
+def llm_priority(state: State) -> int:
+    '''Resume turns are served before new starts as the user has already waited for the earlier turns, batch runs come last'''
+    if get_config().get("configurable", {}).get("batch"):
+        return PRIORITY_BATCH
+    return PRIORITY_START if is_first_turn(state) else PRIORITY_RESUME
+
+
+async def response_cache_node(state: State):
+    if not settings.response_cache_enabled or not is_first_turn(state):
+        return {}
+    query_embedding=await utils.embed_query_async(utils.make_final_message(state['messages']))
+    cached_result=response_cache.get(query_embedding, await utils.catalogue_version_async())
+    if cached_result is None:
+        return {}
+    return {                         # same modifications as analyzer_node for MATCH_FOUND/MORE_INFO
+        "messages": [AIMessage(content=cached_result.user_message)],
+        "analyzer_response": cached_result,
+        "improved_search": False
+    }
+
+
+def response_cache_router(state: State):
+    if state['analyzer_response'] is not None:     # cache hit
+        return "user_info_node"
+    else:
+        return "expander_node"
+
+
+async def speculative_search(user_message: str) -> Optional[dict]:
+    '''Search on the raw user message, runs while the expander call is in flight. A failure only loses the extra hits'''
+    try:
+        return utils.compact_results(await utils.search_chroma_async(query_text=user_message, n_results=settings.speculative_search_results))
+    except Exception as e:
+        print("speculative search failed:", e)
+        return None
+
+
 async def expander_node(state: State):
-    exp_system_prompt=expander_prompt.expander_system_message
-    expander_msgs=[exp_system_prompt]+[HumanMessage(content = utils.make_final_message(state['messages']))]
-    expander_raw_response=await llm_expander.ainvoke(expander_msgs)
+    user_message=utils.make_final_message(state['messages'])
+    expander_msgs=prompt_builder.build_expander_messages(user_message)
+    expander_call=dispatcher.ainvoke(structured_llms()[0], expander_msgs, priority=llm_priority(state), config=prompt_builder.trace_config("expander"), name="expander")
+    speculative_results=None
+    if settings.speculative_search:
+        expander_raw_response, speculative_results=await asyncio.gather(expander_call, speculative_search(user_message))
+    else:
+        expander_raw_response=await expander_call
     expander_response=schemas.ExpanderOutput.model_validate(expander_raw_response)
     return{                       # while return state modifications from this node
         "expander_analysis": expander_response,
-        "retrieved_results": None,
+        "retrieved_results": speculative_results,       # merged with the expander query hits by retrieval_node
         "analyzer_analysis": None,
         "improved_search": False,
         "improved_search_count": 1
@@ -57,8 +123,15 @@ async def retrieval_node(state: State):
             n_results=5
         )
 
+    results = utils.compact_results(results)       # only codes and distances go in the checkpoint
     if state['improved_search']:
         results = utils.merge_retrieved_results(state['retrieved_results'], results)
+    elif search_query is not None and state['retrieved_results'] is not None:      # speculative hits, dropped when the expander didn't ask for a search
+        speculative = state['retrieved_results']
+        new_codes = set(speculative["ids"]) - set(results["ids"] if results else [])
+        metrics.SPECULATIVE_HITS.inc(len(speculative["ids"]) - len(new_codes), kind="repeated")
+        metrics.SPECULATIVE_HITS.inc(len(new_codes), kind="new")
+        results = utils.merge_retrieved_results(results, speculative)
     
     return {
         "retrieved_results": results,
@@ -67,33 +140,18 @@ async def retrieval_node(state: State):
 
 
 async def analyzer_node(state: State):
-    analyzer_chat_prompt=analyzer_prompt.analyzer_chat_prompt
-
     user_input=utils.make_final_message(state['messages'])
-    expander_reasoning=state['expander_analysis'].reasoning
-    expander_division_reason=state['expander_analysis'].division_reason
-    expander_title_reason=state['expander_analysis'].title_reason
-    expander_query=state['expander_analysis'].query
-    expander_note_for_analyzer=state['expander_analysis'].note_for_analyzer
-    expander_clarification_question=state['expander_analysis'].clarification_question
-    retrieved_results=state['retrieved_results']
-
-    analyzer_formatted_messages=analyzer_chat_prompt.format_messages(
+    analyzer_formatted_messages=prompt_builder.build_analyzer_messages(
             user_input=user_input,
-            expander_reasoning=expander_reasoning,
-            expander_division_reason=expander_division_reason,
-            expander_title_reason=expander_title_reason,
-            expander_query=expander_query,
-            expander_note_for_analyzer=expander_note_for_analyzer,
-            expander_clarification_question=expander_clarification_question,
-            retrieved_results=retrieved_results,
+            expander_analysis=state['expander_analysis'],
+            retrieved_results=await utils.hydrate_results(state['retrieved_results']),
             improved_search_counter=state['improved_search_count']
     )
     
     improved_search=False
     count=state['improved_search_count']
     
-    analyzer_raw_result=await llm_analyzer.ainvoke(analyzer_formatted_messages)
+    analyzer_raw_result=await dispatcher.ainvoke(structured_llms()[1], analyzer_formatted_messages, priority=llm_priority(state), config=prompt_builder.trace_config("analyzer"), name="analyzer")
     analyzer_result=schemas.AnalyzerOutput.model_validate(analyzer_raw_result)
     if analyzer_result.status=="IMPROVED_SEARCH":
         improved_search=True
@@ -103,6 +161,10 @@ async def analyzer_node(state: State):
         "improved_search": improved_search,
         "improved_search_count": count            # It is decreased if improved_search 
         }
+    
+    if settings.response_cache_enabled and is_first_turn(state):
+        query_embedding=await utils.embed_query_async(user_input)
+        response_cache.put(query_embedding, analyzer_result, await utils.catalogue_version_async())
        
     return {
         "messages": [AIMessage(content=analyzer_result.user_message)],
@@ -145,18 +207,50 @@ def user_info_router(state: State):
         return "expander_node"
     
 
-builder = StateGraph(State)
-builder.add_node("expander_node", expander_node)
-builder.add_node("analyzer_node", analyzer_node)
-builder.add_node("retrieval_node", retrieval_node)
-builder.add_node("user_info_node", user_info_node)
-builder.add_edge("expander_node","retrieval_node")
-builder.add_edge("retrieval_node","analyzer_node")
-builder.add_conditional_edges("analyzer_node",improved_search_router, {"user_info_node": "user_info_node", "retrieval_node": "retrieval_node"})
-builder.add_conditional_edges("user_info_node", user_info_router, {"expander_node": "expander_node", END: END})
-
-builder.set_entry_point("expander_node")
-graph = builder.compile(checkpointer=utils.checkpointer)
+def build_graph(batch: bool = False) -> StateGraph:
+
+    '''
+    The chat graph. The batch graph(bulk classification) has no human step: MATCH_FOUND and MORE_INFO both end the run
+    at the analyzer, so it never interrupts and is compiled without a checkpointer.
+    '''
+
+    end_of_turn = END if batch else "user_info_node"
+    builder = StateGraph(State)
+    builder.add_node("response_cache_node", metrics.instrument_node("response_cache_node", response_cache_node))
+    builder.add_node("expander_node", metrics.instrument_node("expander_node", expander_node))
+    builder.add_node("analyzer_node", metrics.instrument_node("analyzer_node", analyzer_node))
+    builder.add_node("retrieval_node", metrics.instrument_node("retrieval_node", retrieval_node))
+    builder.add_edge("expander_node","retrieval_node")
+    builder.add_edge("retrieval_node","analyzer_node")
+    builder.add_conditional_edges("analyzer_node",improved_search_router, {"user_info_node": end_of_turn, "retrieval_node": "retrieval_node"})
+    if not batch:
+        builder.add_node("user_info_node", metrics.instrument_node("user_info_node", user_info_node))
+        builder.add_conditional_edges("user_info_node", user_info_router, {"expander_node": "expander_node", END: END})
+
+    builder.add_conditional_edges("response_cache_node", response_cache_router, {"user_info_node": end_of_turn, "expander_node": "expander_node"})
+
+    builder.set_entry_point("response_cache_node")
+    return builder
+
+
+builder = build_graph()
+graph = None
+batch_graph = None
+
+
+def get_graph():
+    '''Compiled on first use, the checkpointer has to be created inside the event loop'''
+    global graph
+    if graph is None:
+        graph = builder.compile(checkpointer=utils.get_checkpointer())
+    return graph
+
+
+def get_batch_graph():
+    global batch_graph
+    if batch_graph is None:
+        batch_graph = build_graph(batch=True).compile()
+    return batch_graph
 
 config={"configurable": {"thread_id": uuid.uuid4()}}
 
@@ -0,0 +1,225 @@
+import asyncio
+import contextvars
+import hashlib
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Any, List
+from langchain_core.messages import BaseMessage
+from .. import utils, metrics
+from ..config import settings
+
+
+'''
+Dispatch layer between the graph nodes and the Groq llm.
+Every llm call of the graph goes through a single priority queue so that bursts of conversations don't hit the Groq rate limits
+(and the max_retries backoffs of ChatGroq). The queue:
+- enforces token buckets on requests per minute and tokens per minute
+- serves resume turns before new starts(lower number = higher priority)
+- coalesces identical prompts which are already in flight into a single call, a queued call takes the best priority of its callers
+- drops a queued call once every caller waiting on it was cancelled(e.g. a disconnected client or an abandoned batch)
+- keeps queue depth and wait time metrics
+- unwraps structured output made with include_raw=True and records the prompt/completion tokens of every call
+'''
+
+PRIORITY_RESUME = 0
+PRIORITY_START = 1
+PRIORITY_BATCH = 2
+
+COMPLETION_TOKENS_ESTIMATE = 512     # counted against tokens per minute along with the prompt tokens
+
+
+class TokenBucket:
+
+    '''Bucket refilled continuously at rate_per_minute. A rate of 0 disables the limit.'''
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.tokens = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        if self.rate == 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)     # a single call bigger than the bucket waits for a full bucket
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        if self.rate == 0:
+            return
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class LLMJob:
+
+    def __init__(self, key: str, name: str, priority: int, runnable, messages: List[BaseMessage], tokens: int, config: dict | None):
+        self.key = key
+        self.name = name
+        self.priority = priority
+        self.runnable = runnable
+        self.messages = messages
+        self.tokens = tokens
+        self.config = config
+        self.future = asyncio.get_running_loop().create_future()
+        self.context = contextvars.copy_context()     # the call runs in the caller's context so tracing and token streaming still work
+        self.enqueued_at = time.monotonic()
+        self.waiters = 0          # callers awaiting the future, coalesced ones included
+        self.started = False
+
+
+class LLMDispatcher:
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, max_concurrency: int):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.queue: list = []                    # heap of (priority, sequence, job)
+        self.in_flight: dict[str, LLMJob] = {}   # prompt key -> job, used for coalescing
+        self.sequence = itertools.count()
+        self.running = 0
+        self.wakeup = None
+        self.worker = None
+        self.tasks: set = set()                  # running calls, referenced so they are not garbage collected mid-flight
+        self.wait_times = deque(maxlen=1000)    # seconds spent in the queue by the recent calls
+        self.completed = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    @staticmethod
+    def prompt_key(runnable, messages: List[BaseMessage]) -> str:
+        digest = hashlib.sha256(str(id(runnable)).encode())
+        for msg in messages:
+            digest.update(msg.type.encode())
+            digest.update(b"\0")
+            digest.update(str(msg.content).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _ensure_worker(self):
+        if self.worker is None or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = asyncio.create_task(self._worker_loop())
+
+    async def ainvoke(self, runnable, messages: List[BaseMessage], priority: int = PRIORITY_START, config: dict | None = None, name: str = "llm") -> Any:
+        key = self.prompt_key(runnable, messages)
+        job = self.in_flight.get(key)
+        if job is not None:
+            self.coalesced += 1
+            if priority < job.priority and not job.started:
+                self._reprioritize(job, priority)
+        else:
+            job = LLMJob(key, name, priority, runnable, messages, utils.estimate_tokens(messages) + COMPLETION_TOKENS_ESTIMATE, config)
+            self.in_flight[key] = job
+            heapq.heappush(self.queue, (priority, next(self.sequence), job))
+            self._ensure_worker()
+            self.wakeup.set()
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.future)      # a cancelled caller must not cancel the call for coalesced callers
+        finally:
+            job.waiters -= 1
+            if job.waiters == 0 and not job.started and not job.future.done():
+                self._drop(job)
+
+    def _reprioritize(self, job: LLMJob, priority: int):
+        '''A resume turn joining a queued batch call must not wait behind the other batch calls'''
+        job.priority = priority
+        self.queue = [(priority, sequence, queued) if queued is job else (queued_priority, sequence, queued) for queued_priority, sequence, queued in self.queue]
+        heapq.heapify(self.queue)
+
+    def _drop(self, job: LLMJob):
+        '''Removes a queued job nobody waits for anymore, it never reaches Groq'''
+        self.queue = [entry for entry in self.queue if entry[2] is not job]
+        heapq.heapify(self.queue)
+        if self.in_flight.get(job.key) is job:
+            del self.in_flight[job.key]
+        job.future.cancel()
+        self.dropped += 1
+
+    async def _worker_loop(self):
+        while True:
+            if not self.queue or self.running >= self.max_concurrency:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            _, _, job = self.queue[0]
+            wait = max(self.request_bucket.wait_time(1), self.token_bucket.wait_time(job.tokens))
+            if wait > 0:
+                await asyncio.sleep(wait)     # the head of queue is checked again as a higher priority call may have come in
+                continue
+
+            heapq.heappop(self.queue)
+            job.started = True
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(job.tokens)
+            self.wait_times.append(time.monotonic() - job.enqueued_at)
+            metrics.LLM_QUEUE_WAIT_SECONDS.observe(self.wait_times[-1], priority=job.priority)
+            self.running += 1
+            task = asyncio.create_task(self._run(job), context=job.context)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, job: LLMJob):
+        try:
+            with metrics.LLM_CALL_SECONDS.time(name=job.name):
+                result = await job.runnable.ainvoke(job.messages, config=job.config)
+            job.future.set_result(self._unwrap(job, result))
+            self.completed += 1
+        except Exception as e:
+            job.future.set_exception(e)
+            if job.waiters == 0:
+                job.future.exception()      # every caller was cancelled while it ran, nobody else retrieves it
+            metrics.LLM_ERRORS.inc(name=job.name)
+            self.failed += 1
+        finally:
+            if self.in_flight.get(job.key) is job:
+                del self.in_flight[job.key]
+            self.running -= 1
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+    @staticmethod
+    def _unwrap(job: LLMJob, result):
+        if not (isinstance(result, dict) and "raw" in result and "parsed" in result):
+            return result
+        usage = getattr(result["raw"], "usage_metadata", None) or {}
+        metrics.LLM_PROMPT_TOKENS.observe(usage.get("input_tokens", job.tokens - COMPLETION_TOKENS_ESTIMATE), name=job.name)
+        if "output_tokens" in usage:
+            metrics.LLM_COMPLETION_TOKENS.observe(usage["output_tokens"], name=job.name)
+        if result.get("parsing_error") is not None:
+            raise result["parsing_error"]
+        return result["parsed"]
+
+    def stats(self) -> dict:
+        waits = sorted(self.wait_times)
+        return {
+            "queue_depth": len(self.queue),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "wait_seconds_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_seconds_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "wait_seconds_max": waits[-1] if waits else 0.0
+        }
+
+
+dispatcher = LLMDispatcher(
+    requests_per_minute=settings.llm_requests_per_minute,
+    tokens_per_minute=settings.llm_tokens_per_minute,
+    max_concurrency=settings.llm_max_concurrency
+)
@@ -0,0 +1,111 @@
+import hashlib
+from typing import List, Tuple
+from langchain_core.messages import BaseMessage, HumanMessage
+from . import expander_prompt, analyzer_prompt
+from ... import utils, metrics
+
+
+'''
+Prompt assembly for the expander and analyzer llm calls.
+The system messages are large and static so they are built once at import time and reused as they are,
+only the dynamic human message is rendered for every call(with plain str.format instead of re-running ChatPromptTemplate).
+The retrieved documents are rendered as a compact, deterministic table instead of the raw chroma result dict.
+
+Every message list starts with a fixed, byte-identical static prefix(the system message) followed by the dynamic suffix,
+so that provider-side prompt caching can reuse the prefix across calls. The hash of the prefix is attached to the
+trace metadata of every call and tests/test_prompt_prefix.py pins it, so an edit of the prompt text is deliberate.
+'''
+
+ANALYZER_HUMAN_TEMPLATE = analyzer_prompt.analyzer_human_message.prompt.template     # precompiled once, it is a f-string style template
+
+RETRIEVED_TABLE_HEADER = "rank | code | title | family | division | distance | description"
+NO_RETRIEVED_RESULTS = "No documents were retrieved because the search query was not generated."
+
+EXPANDER_PREFIX: Tuple[BaseMessage, ...] = (expander_prompt.expander_system_message,)
+ANALYZER_PREFIX: Tuple[BaseMessage, ...] = (analyzer_prompt.analyzer_system_message,)
+
+
+def prefix_hash(prefix) -> str:
+    digest = hashlib.sha256()
+    for msg in prefix:
+        digest.update(msg.type.encode())
+        digest.update(b"\0")
+        digest.update(str(msg.content).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+PREFIX_HASHES = {
+    "expander": prefix_hash(EXPANDER_PREFIX),
+    "analyzer": prefix_hash(ANALYZER_PREFIX)
+}
+
+STATIC_TOKENS = {
+    "expander": utils.estimate_tokens(list(EXPANDER_PREFIX)),
+    "analyzer": utils.estimate_tokens(list(ANALYZER_PREFIX))
+}
+
+
+def _cell(value) -> str:
+    return " ".join(str(value if value is not None else "").split()).replace("|", "/")
+
+
+def _description(document: str) -> str:
+    '''The documents are "Division: ... | Title: ... | Description: ...", division and title are already in their own columns'''
+    if document and "Description:" in document:
+        return document.split("Description:", 1)[1]
+    return document or ""
+
+
+def format_retrieved_results(retrieved_results) -> str:
+    if not retrieved_results:
+        return NO_RETRIEVED_RESULTS
+    rows = [RETRIEVED_TABLE_HEADER]
+    for rank, (code, distance, document, metadata) in enumerate(zip(
+        retrieved_results["ids"][0],
+        retrieved_results["distances"][0],
+        retrieved_results["documents"][0],
+        retrieved_results["metadatas"][0]
+    ), start=1):
+        metadata = metadata or {}
+        rows.append(" | ".join([
+            str(rank),
+            _cell(code),
+            _cell(metadata.get("occupation_title")),
+            _cell(metadata.get("family_name")),
+            _cell(metadata.get("division_name")),
+            f"{distance:.3f}",
+            _cell(_description(document))
+        ]))
+    return "\n".join(rows)
+
+
+def build_expander_messages(user_input: str) -> List[BaseMessage]:
+    messages = [*EXPANDER_PREFIX, HumanMessage(content=user_input)]
+    metrics.PROMPT_TOKENS.observe(STATIC_TOKENS["expander"], prompt="expander", part="static")
+    metrics.PROMPT_TOKENS.observe(utils.estimate_tokens(messages[len(EXPANDER_PREFIX):]), prompt="expander", part="dynamic")
+    return messages
+
+
+def build_analyzer_messages(user_input: str, expander_analysis, retrieved_results, improved_search_counter: int) -> List[BaseMessage]:
+    human_content = ANALYZER_HUMAN_TEMPLATE.format(
+        user_input=user_input,
+        expander_reasoning=expander_analysis.reasoning,
+        expander_division_reason=expander_analysis.division_reason,
+        expander_title_reason=expander_analysis.title_reason,
+        expander_query=expander_analysis.query,
+        expander_note_for_analyzer=expander_analysis.note_for_analyzer,
+        expander_clarification_question=expander_analysis.clarification_question,
+        retrieved_results=format_retrieved_results(retrieved_results),
+        improved_search_counter=improved_search_counter
+    )
+    messages = [*ANALYZER_PREFIX, HumanMessage(content=human_content)]
+    metrics.PROMPT_TOKENS.observe(STATIC_TOKENS["analyzer"], prompt="analyzer", part="static")
+    metrics.PROMPT_TOKENS.observe(utils.estimate_tokens(messages[len(ANALYZER_PREFIX):]), prompt="analyzer", part="dynamic")
+    return messages
+
+
+def trace_config(prompt: str) -> dict:
+    '''Run config for the llm call, the prefix hash shows up in the langsmith trace metadata'''
+    return {"metadata": {"prompt": prompt, "prompt_prefix_hash": PREFIX_HASHES[prompt]}}
+
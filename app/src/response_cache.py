@@ -0,0 +1,87 @@
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Optional
+from .schemas import AnalyzerOutput
+
+
+'''
+Semantic cache of whole classifications for the first message of a chat.
+Many first messages are essentially the same("I am a nurse in a government hospital"), so if the embedding of a new first message
+is close enough(cosine similarity >= threshold) to a cached one, the cached AnalyzerOutput is returned and the expander/analyzer llm calls are skipped.
+Only MATCH_FOUND and MORE_INFO outcomes are cached. Entries expire after ttl seconds and all entries are dropped when the
+version of the embeddings collection changes because the cached codes may not be valid anymore.
+'''
+
+CACHEABLE_STATUS = ("MATCH_FOUND", "MORE_INFO")
+
+
+class ResponseCache:
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, max_size: int = 512):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.version = None
+        self.entries: "OrderedDict[int, tuple]" = OrderedDict()     # key -> (normalized embedding, AnalyzerOutput, created_at)
+        self.next_key = 0
+        self.hits = 0
+        self.misses = 0
+        self._keys = None
+        self._matrix = None
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        return embedding / (np.linalg.norm(embedding) + 1e-12)
+
+    def _check_version(self, version: str):
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [key for key, (_, _, created_at) in self.entries.items() if now - created_at > self.ttl]
+        for key in expired:
+            del self.entries[key]
+        if expired:
+            self._matrix = None
+
+    def clear(self):
+        self.entries.clear()
+        self._matrix = None
+
+    def get(self, embedding, version: str) -> Optional[AnalyzerOutput]:
+        self._check_version(version)
+        self._evict_expired()
+        if not self.entries:
+            self.misses += 1
+            return None
+        if self._matrix is None:
+            self._keys = list(self.entries.keys())
+            self._matrix = np.stack([entry[0] for entry in self.entries.values()])
+
+        similarities = self._matrix @ self._normalize(embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            self.misses += 1
+            return None
+
+        key = self._keys[best]
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key][1].model_copy(deep=True)
+
+    def put(self, embedding, analyzer_output: AnalyzerOutput, version: str):
+        if analyzer_output.status not in CACHEABLE_STATUS:
+            return
+        self._check_version(version)
+        self.entries[self.next_key] = (self._normalize(embedding), analyzer_output.model_copy(deep=True), time.monotonic())
+        self.next_key += 1
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self._matrix = None
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+
+'''
+Startup phases of the app and their timings.
+Importing the app doesn't create the llm, the chroma client, the embedding model or the checkpointer(see the getters in utils),
+the lifespan warms them up here with independent phases running concurrently, and logs how long each one took.
+With lazy_startup the lifespan doesn't wait for the phases, the app serves /healthz right away and /readyz only reports
+ready once every required phase has finished, so the autoscaler sends traffic to warm workers only.
+'''
+
+
+class Startup:
+
+    def __init__(self):
+        self.phases: Dict[str, dict] = {}
+        self.ready = False
+        self.failed = False
+        self.started_at: Optional[float] = None
+        self.total_seconds = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    async def phase(self, name: str, step: Callable[[], Awaitable], required: bool = True):
+        '''Runs one phase. A failed required phase is raised, an optional one(e.g. the index with its chroma fallback) is only logged'''
+        started = time.perf_counter()
+        self.phases[name] = {"status": "running"}
+        try:
+            await step()
+        except Exception as e:
+            seconds = time.perf_counter() - started
+            self.phases[name] = {"status": "failed", "seconds": round(seconds, 3), "error": str(e)[:200]}
+            print(f"startup phase {name} failed after {seconds:.2f}s:", e)
+            if required:
+                raise
+            return
+        seconds = time.perf_counter() - started
+        self.phases[name] = {"status": "done", "seconds": round(seconds, 3)}
+        print(f"startup phase {name}: {seconds:.2f}s")
+
+    async def run(self, *phases: Awaitable):
+        '''Runs the phases concurrently, phases that depend on each other are chained inside one coroutine'''
+        self.started_at = time.perf_counter()
+        try:
+            await asyncio.gather(*phases)
+        except Exception:
+            self.failed = True
+            raise
+        finally:
+            self.total_seconds = time.perf_counter() - self.started_at
+        self.ready = True
+        print(f"startup finished in {self.total_seconds:.2f}s")
+
+    def start(self, warm_up: Awaitable):
+        '''lazy_startup: runs the warm up(which calls run) in the background'''
+        async def run_logged():
+            try:
+                await warm_up
+            except Exception as e:
+                self.failed = True
+                print("startup failed, /readyz stays unavailable:", e)
+        self.task = asyncio.create_task(run_logged())
+
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def status(self) -> dict:
+        return {
+            "status": "ready" if self.ready else "failed" if self.failed else "starting",
+            "seconds": round(self.total_seconds, 3),
+            "phases": self.phases
+        }
+
+
+startup = Startup()
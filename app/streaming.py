@@ -0,0 +1,80 @@
+import json
+from typing import Any, AsyncIterator, Tuple
+from langchain_core.messages import AIMessageChunk
+from .src import graph
+from . import utils
+
+
+'''
+Server-Sent Events support for the streaming chat endpoints.
+The graph is run with astream so that every node's update is pushed to the client as soon as it is available
+instead of waiting for expander -> retrieval -> analyzer to finish.
+
+Events sent to the client:
+- expander  : {"is_query_generated": bool, "query": str}
+- retrieval : {"hits": [{"code", "title", "distance"}]}
+- analyzer  : {"status": "MATCH_FOUND" | "MORE_INFO" | "IMPROVED_SEARCH"}
+- token     : {"count": int}     progress tick while the analyzer llm generates, the chunks themselves are its structured output
+                                  (thought process, status, system directive) and are never sent to the client
+- result    : ChatResponse
+- error     : ErrorDetail
+'''
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"     # stops reverse proxies(nginx, render) from buffering the stream
+}
+
+
+def format_sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def summarize_hits(retrieved_results) -> list:
+    '''Picks only the fields the client needs, the titles are rehydrated from the catalogue as the state only has codes and distances'''
+    retrieved_results = await utils.hydrate_results(retrieved_results)
+    if not retrieved_results:
+        return []
+    hits = []
+    for code, distance, metadata in zip(retrieved_results["ids"][0], retrieved_results["distances"][0], retrieved_results["metadatas"][0]):
+        hits.append({"code": code, "title": (metadata or {}).get("occupation_title"), "distance": distance})
+    return hits
+
+
+async def stream_graph_events(graph_input, config: dict) -> AsyncIterator[Tuple[str, dict]]:
+
+    '''Runs the graph and yields (event, data) tuples. The last tuple is always the "result" event.'''
+
+    final_message = None
+    interrupt_value = None
+    analyzer_chunks = 0
+    async for mode, chunk in graph.get_graph().astream(graph_input, config=config, stream_mode=["updates", "messages"], durability="exit"):
+        if mode == "messages":
+            message, metadata = chunk
+            if isinstance(message, AIMessageChunk) and metadata.get("langgraph_node") == "analyzer_node" and message.content:
+                analyzer_chunks += 1
+                yield "token", {"count": analyzer_chunks}
+            continue
+
+        for node, update in chunk.items():
+            if node == "__interrupt__":      # the stream is drained till the end so that the checkpoint is written on exit
+                interrupt_value = update[0].value
+                continue
+            if not update:
+                continue
+            if node == "expander_node":
+                yield "expander", {
+                    "is_query_generated": update["expander_analysis"].is_query_generated,
+                    "query": update["expander_analysis"].query
+                }
+            elif node == "retrieval_node":
+                yield "retrieval", {"hits": await summarize_hits(update["retrieved_results"])}
+            elif node in ("analyzer_node", "response_cache_node"):
+                yield "analyzer", {"status": update["analyzer_response"].status}
+                if update.get("messages"):
+                    final_message = update["messages"][-1].content
+
+    if interrupt_value is not None:
+        yield "result", {"result": interrupt_value, "status": "MORE_INFO"}
+    else:
+        yield "result", {"result": final_message, "status": "MATCH_FOUND"}
@@ -1,37 +1,289 @@
 import asyncio
-from langchain_groq import ChatGroq
-import chromadb
+import os
+import re
+import threading
+import numpy as np
+from collections import OrderedDict
 from langchain_core.messages import BaseMessage, AIMessage, HumanMessage
 from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
 from pathlib import Path
-from .config import settings, EMBEDDINGS_PATH
+from .config import settings, EMBEDDINGS_PATH, INDEX_CACHE_PATH
 import uuid
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from .database import checkpointer_pool
-from chromadb.utils import embedding_functions
-from langchain_chroma import Chroma
-from chromadb.utils import embedding_functions
+from .vector_index import CatalogueIndex
+from .lexical_index import LexicalIndex, reciprocal_rank_fusion
+import gc
+from . import metrics
 
 
-llm=ChatGroq(
-    model="llama-3.1-8b-instant",
-    temperature=0.01,
-    max_retries=3,
-    api_key=f"{settings.groq_api_key}"
+# The llm, chroma client, embedding model and checkpointer are created on first use(or warmed up by the lifespan),
+# importing the app only loads what is needed to define the routes. chromadb and langchain_groq are imported in the getters.
+
+COLLECTION_NAME = "EmbeddingsV-0.2_all-MiniLM-L6-v2"
+DIVISION_LABEL = re.compile(r"Division:\s*([^|]*)", re.IGNORECASE)     # expander and IMPROVED_SEARCH queries start with "Division: ... |"
+
+llm = None              # get_llm(), the benchmarks set a fake one before the graph is compiled
+client = None
+collection = None       # get_collection()
+query_embedder = None   # get_query_embedder(), one onnxruntime session for the process
+checkpointer = None     # get_checkpointer(), created inside the event loop
+catalogue_index=CatalogueIndex(
+    None,
+    cache_dir=INDEX_CACHE_PATH,
+    use_mmap=settings.vector_index_mmap,
+    quantization=settings.vector_index_quantization,
+    rerank_candidates=settings.vector_index_rerank_candidates
+)    # loaded in the lifespan, the collection is set by get_collection()
+lexical_index=LexicalIndex(cache_dir=INDEX_CACHE_PATH)        # hybrid_retrieval, built over the rows of catalogue_index
+_init_lock = threading.Lock()        # the chroma and embedding getters are also called from worker threads
+
+
+def get_llm():
+    global llm
+    if llm is None:
+        from langchain_groq import ChatGroq
+        llm=ChatGroq(
+            model="llama-3.1-8b-instant",
+            temperature=0.01,
+            max_retries=3,
+            api_key=f"{settings.groq_api_key}"
+        )
+    return llm
+
+
+def get_collection():
+    global client, collection
+    with _init_lock:
+        if collection is None:
+            import chromadb
+            client = chromadb.PersistentClient(EMBEDDINGS_PATH)
+            collection = client.get_collection(COLLECTION_NAME)     # queried with embeddings from get_query_embedder(), never with texts
+            catalogue_index.collection = collection
+    return collection
+
+
+def get_query_embedder():
+    global query_embedder
+    with _init_lock:
+        if query_embedder is None:
+            from .embedding import QueryEmbedder
+            query_embedder = QueryEmbedder(intra_op_threads=settings.onnx_intra_op_threads)     # the session is created on the first call
+    return query_embedder
+
+
+def get_checkpointer():
+    global checkpointer
+    if checkpointer is None:
+        checkpointer = AsyncPostgresSaver(checkpointer_pool)
+    return checkpointer
+
+
+def load_catalogue_index():
+    get_collection()
+    catalogue_index.load()
+    if settings.hybrid_retrieval:
+        lexical_index.load(COLLECTION_NAME, catalogue_index.version, catalogue_index.documents, catalogue_index.metadatas)
+
+
+def catalogue_version() -> str:
+    if not catalogue_index.is_loaded:
+        get_collection()
+    return catalogue_index.current_version()
+
+
+async def catalogue_version_async() -> str:
+    '''Without the index the version is read from chromadb(metadata, count), off the event loop'''
+    if catalogue_index.is_loaded:
+        return catalogue_index.version
+    return await asyncio.to_thread(catalogue_version)
+
+class QueryEmbeddingCache:
+    
+    '''
+    LRU cache of query embeddings keyed on the normalized query text.
+    Expander queries(Division: ... | Title: ... | Description: ...) repeat a lot across users so most of them can skip the embedding model.
+    It is only used from the event loop so no locking is needed.
+    '''
+    
+    MODEL_NAME = "all-MiniLM-L6-v2"     # persisted entries are only reused for the same model
+    
+    def __init__(self, max_size: int = 2048, persist_path: Optional[Path] = None):
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    @staticmethod
+    def normalize(query_text: str) -> str:
+        text = " ".join(query_text.lower().split())
+        text = re.sub(r"\s*([|:,])\s*", r"\1 ", text)
+        return text.strip(" .")
+    
+    def get(self, key: str) -> Optional[np.ndarray]:
+        embedding = self.entries.get(key)
+        if embedding is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return embedding
+    
+    def put(self, key: str, embedding: np.ndarray):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+            
+    def load(self):
+        if self.persist_path is None or not self.persist_path.exists():
+            return
+        with np.load(self.persist_path, allow_pickle=False) as data:
+            if str(data["model"]) != self.MODEL_NAME:
+                return
+            for key, embedding in zip(data["keys"].tolist(), data["embeddings"]):
+                self.put(key, embedding)
+        print(f"loaded {len(self.entries)} cached query embeddings")
+        
+    def save(self):
+        if self.persist_path is None or not self.entries:
+            return
+        self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.persist_path.with_name(f"{self.persist_path.name}.{os.getpid()}.tmp")     # every worker saves on shutdown, the last one wins
+        with open(temp_path, "wb") as f:
+            np.savez(
+                f,
+                model=np.array(self.MODEL_NAME),
+                keys=np.array(list(self.entries.keys())),
+                embeddings=np.stack(list(self.entries.values()))
+            )
+        os.replace(temp_path, self.persist_path)
+
+
+query_embedding_cache=QueryEmbeddingCache(
+    max_size=settings.query_cache_size,
+    persist_path=Path(INDEX_CACHE_PATH / "query_embeddings.npz") if settings.query_cache_persist else None
 )
 
-client = chromadb.PersistentClient(EMBEDDINGS_PATH)
-default_ef=embedding_functions.DefaultEmbeddingFunction()
-collection=client.get_collection("EmbeddingsV-0.2_all-MiniLM-L6-v2", embedding_function=default_ef)
+
+def preload_shared():
+
+    '''
+    Multi-worker mode(gunicorn.conf.py): runs once in the parent after the app is imported and before the workers are forked.
+    The read-only catalogue(memory-mapped vectors, ids, documents, metadatas) is loaded here and shared copy-on-write with every worker,
+    the embedding model files are downloaded once. The onnxruntime session itself is created in each worker as it is not fork-safe.
+    '''
+
+    if settings.vector_index_enabled:
+        try:
+            load_catalogue_index()
+        except Exception as e:
+            print("could not load the catalogue index, falling back to chroma:", e)
+    try:
+        get_query_embedder().download()
+        query_embedding_cache.load()
+    except Exception as e:
+        print("could not preload the embedding model, the workers will load it on first use:", e)
+    gc.collect()
+    gc.freeze()     # keeps the shared objects out of the gc so the workers don't dirty their pages
+
+
+def reopen_after_fork():
+    '''Runs in every worker after the fork, the chroma client(sqlite and its rust runtime) of the parent can't be used in the child'''
+    global client, collection
+    if client is not None:
+        from chromadb.api.client import SharedSystemClient
+        SharedSystemClient.clear_system_cache()
+        client = collection = None      # reopened by get_collection() in the worker
+
+
+async def embed_query_async(query_text: str) -> np.ndarray:
+    key = query_embedding_cache.normalize(query_text)
+    embedding = query_embedding_cache.get(key)
+    if embedding is None:
+        with metrics.EMBEDDING_SECONDS.time():
+            embedding = np.asarray((await asyncio.to_thread(lambda: get_query_embedder()([key])))[0], dtype=np.float32)     # only the embedding model runs in the thread
+        query_embedding_cache.put(key, embedding)
+    return embedding
+
+
+def hybrid_search(query_text: str, query_embedding: np.ndarray, n_results: int = 5, rows: Optional[np.ndarray] = None, distances: Optional[np.ndarray] = None) -> dict:
+    '''Reciprocal-rank fusion of the vector and BM25 candidates, the results keep the vector distances of the rows'''
+    if distances is None:
+        distances = catalogue_index.distances(query_embedding, rows)
+    vector_rows = catalogue_index.top_k(distances, settings.hybrid_candidates)
+    lexical_rows = lexical_index.top_k(query_text, settings.hybrid_candidates, rows)
+    rows = reciprocal_rank_fusion([vector_rows, lexical_rows], k=settings.rrf_k)[:n_results]
+    catalogue_index.rescore(query_embedding, distances, rows)      # lexical hits may be outside the reranked shortlist of a quantized scan
+    return catalogue_index.build_results(rows, distances)
+
+
+def index_search(query_text: str, query_embedding: np.ndarray, n_results: int = 5, rows: Optional[np.ndarray] = None, distances: Optional[np.ndarray] = None) -> dict:
+    '''Blocking. Search of the in-process index(hybrid when the lexical index is loaded), distances are computed when not given'''
+    if distances is None:
+        distances = catalogue_index.distances(query_embedding, rows)
+    if lexical_index.is_loaded:
+        return hybrid_search(query_text, query_embedding, n_results, rows, distances)
+    return catalogue_index.build_results(catalogue_index.top_k(distances, n_results), distances)
+
+
+def query_division_rows(query_text: str) -> Optional[np.ndarray]:
+    '''Rows of the divisions named in the "Division: ... |" part of the query, None when it names none(or all of them)'''
+    label = DIVISION_LABEL.search(query_text or "")
+    if label is None:
+        return None
+    return catalogue_index.division_rows(catalogue_index.match_divisions(label.group(1)))
+
+
+def division_search(query_text: str, query_embedding: np.ndarray, n_results: int = 5) -> Tuple[dict, str]:
+
+    '''
+    Blocking. Searches only the rows of the division the expander(or the analyzer's IMPROVED_SEARCH query) chose, so the scan covers
+    a fraction of the catalogue and the analyzer gets no off-division candidates.
+    Falls back to the whole catalogue when the division is missing or ambiguous, when the division has fewer than n_results rows
+    or when its best hit is below division_min_similarity(the division was probably wrong). The fallback only scores the rows
+    outside the division, the distances of the division are reused. Returns the results and the outcome for the metrics.
+    '''
+
+    rows = query_division_rows(query_text)
+    if rows is None:
+        return index_search(query_text, query_embedding, n_results), "no_division"
+    distances = catalogue_index.distances(query_embedding, rows)
+    results = index_search(query_text, query_embedding, n_results, rows, distances)
+    result_distances = results["distances"][0]
+    if len(result_distances) < n_results:
+        outcome = "few_results"
+    elif catalogue_index.similarity(min(result_distances)) < settings.division_min_similarity:
+        outcome = "low_similarity"
+    else:
+        return results, "partition"
+    others = catalogue_index.other_rows(rows)
+    distances[others] = catalogue_index.distances(query_embedding, others)[others]
+    return index_search(query_text, query_embedding, n_results, distances=distances), outcome
+
 
 async def search_chroma_async(query_text: str, n_results: int = 5):
     
-    def blocking_search():
-        return collection.query(
-            query_texts=[query_text],
+    query_embedding = await embed_query_async(query_text)
+    if catalogue_index.is_loaded:
+        with metrics.VECTOR_SEARCH_SECONDS.time(backend="hybrid" if lexical_index.is_loaded else "index"):      # numpy scan and BM25 scoring run off the event loop
+            if not settings.division_retrieval:
+                return await asyncio.to_thread(index_search, query_text, query_embedding, n_results)
+            results, outcome = await asyncio.to_thread(division_search, query_text, query_embedding, n_results)      # the fallback runs in the same thread call
+        metrics.DIVISION_SEARCHES.inc(outcome=outcome)
+        return results
+
+    def blocking_search():       # fallback when the in-process index is disabled or failed to load
+        return get_collection().query(
+            query_embeddings=[query_embedding],
             n_results=n_results
         )
-    results = await asyncio.to_thread(blocking_search)
+    with metrics.VECTOR_SEARCH_SECONDS.time(backend="chroma"):
+        results = await asyncio.to_thread(blocking_search)
     
     return results
 '''
@@ -57,14 +309,64 @@ def make_final_message(messages: List[BaseMessage]) -> str:
     return final_message
 
 
-def merge_retrieved_results(old: dict, new: dict):
-    for key in ["distances", "documents", "metadatas", "ids"]:
-        try:
-            old[key][0].extend(new[key][0])
-        except AttributeError:
-            raise Exception("The retrieved_results do not have the necessary attributes")
-        return old
+def compact_results(results: Optional[dict]) -> Optional[dict]:
+
+    '''
+    Only the occupation codes and distances of the retrieved results are kept in the graph state(and so in every checkpoint),
+    the documents and metadatas are rehydrated from the catalogue when the analyzer needs them.
+    Accepts the chroma shaped dict(also found in checkpoints written before) or an already compact one.
+    '''
+
+    if not results:
+        return None
+    ids, distances = results["ids"], results["distances"]
+    if ids and isinstance(ids[0], list):        # chroma shaped, one list per query
+        ids, distances = ids[0], distances[0]
+    return {"ids": list(ids), "distances": [float(distance) for distance in distances]}
+
+
+def merge_retrieved_results(old: Optional[dict], new: Optional[dict]) -> Optional[dict]:
+    '''Merges the results of the improved search into the old ones. Old results come first and a repeated code keeps its best distance'''
+    old, new = compact_results(old), compact_results(new)
+    if old is None or new is None:
+        return old or new
+    merged = {}
+    for code, distance in zip(old["ids"] + new["ids"], old["distances"] + new["distances"]):
+        if code not in merged or distance < merged[code]:
+            merged[code] = distance
+    return {"ids": list(merged), "distances": list(merged.values())}
+
+
+async def hydrate_results(results: Optional[dict]) -> Optional[dict]:
+
+    '''Rebuilds the chroma shaped results(ids, distances, documents, metadatas) from the compact ones in the state'''
+
+    results = compact_results(results)
+    if results is None:
+        return None
+    ids = results["ids"]
+    records = catalogue_index.lookup(ids) if catalogue_index.is_loaded else None
+
+    if records is None:         # index disabled or the catalogue changed after the checkpoint was written
+        fetched = await asyncio.to_thread(lambda: get_collection().get(ids=ids, include=["documents", "metadatas"]))
+        by_id = {code: (document, metadata) for code, document, metadata in zip(fetched["ids"], fetched["documents"], fetched["metadatas"])}
+        ids = [code for code in ids if code in by_id]
+        records = {
+            "ids": [ids],
+            "documents": [[by_id[code][0] for code in ids]],
+            "metadatas": [[by_id[code][1] for code in ids]]
+        }
+
+    distance_of = dict(zip(results["ids"], results["distances"]))
+    records["distances"] = [[distance_of[code] for code in records["ids"][0]]]
+    return records
+
    
+def estimate_tokens(messages: List[BaseMessage]) -> int:
+    '''Rough token count of the messages(~4 characters per token for llama tokenizer on english text)'''
+    return sum(len(str(msg.content)) for msg in messages) // 4
+
+
 def generate_initial_state(msg: str):
     initial_state_dict={
         "messages":[HumanMessage(content=msg)],
@@ -75,8 +377,3 @@ def generate_initial_state(msg: str):
         "improved_search_count": 0   
     }
     return initial_state_dict
-  
-
-# graph compile and checkpointer 
-
-checkpointer = AsyncPostgresSaver(checkpointer_pool)
\ No newline at end of file
@@ -0,0 +1,279 @@
+import json
+import os
+import re
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional
+from .lexical_index import tokenize
+
+
+'''
+In-process vector index for the NCO catalogue.
+The catalogue is only a few thousand occupations, so instead of going through chromadb(and its SQLite) for every query,
+all the vectors are loaded once into a contiguous float32 matrix and top-k is answered with a single dot product.
+The matrix is cached in a .npy file next to a small json file(ids, documents, metadatas) so later startups can memory-map it
+instead of reading the whole collection again. ChromaDB remains the source of truth and the fallback path.
+
+Optionally the scan runs over an int8 copy(with a scale per row) and only the rerank_candidates best rows are scored again
+with the float32 vectors. This is a memory saving, not a speed up: numpy has no int8 matrix product, so the scan converts the rows
+back to float32 chunk by chunk and is slower than the float32 scan on a small catalogue(benchmarks/bench_retrieval.py).
+With mmap the float32 matrix then stays in the page cache(shared by the workers) and only the shortlisted rows are read,
+the per-worker memory is the int8 copy, a quarter of the float32 matrix.
+
+The rows are also grouped by division_name, so a search can scan only the divisions named in the query(see match_divisions).
+'''
+
+QUANTIZATION_MODES = ("none", "int8")
+SCAN_CHUNK = 1024       # rows converted to float32 at a time during the coarse scan, small enough to stay in cache
+DIVISION_SEPARATORS = re.compile(r"\s*(?:/|\bor\b)\s*", re.IGNORECASE)     # "Professionals / Associate Professionals"
+DIVISION_NUMBERS = re.compile(r"\b([1-9])\b")                                 # "Div 7", "Division 2 or 3"
+
+
+class CatalogueIndex:
+
+    def __init__(self, collection, cache_dir: Optional[Path] = None, use_mmap: bool = True, quantization: str = "none", rerank_candidates: int = 50):
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"quantization must be one of {QUANTIZATION_MODES}, got {quantization}")
+        self.collection = collection
+        self.cache_dir = cache_dir
+        self.use_mmap = use_mmap
+        self.quantization = quantization
+        self.rerank_candidates = rerank_candidates
+        self.quantized: Optional[np.ndarray] = None
+        self.row_scales: Optional[np.ndarray] = None      # int8 only, vectors ~= quantized * row_scales
+        self.space = "l2"
+        self.version = None
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[dict] = []
+        self.vectors: Optional[np.ndarray] = None
+        self.sq_norms: Optional[np.ndarray] = None
+        self.row_of: dict = {}
+        self.partitions: Dict[str, np.ndarray] = {}       # division_name -> sorted rows
+        self.division_tokens: Dict[str, set] = {}
+        self.division_of_number: Dict[str, str] = {}      # first digit of the occupation codes -> division_name
+        self.is_loaded = False
+
+    def collection_version(self) -> str:
+        '''Version used to validate the cache. prepare_embeddings.py may write "catalogue_version" in collection metadata'''
+        metadata = self.collection.metadata or {}
+        return str(metadata.get("catalogue_version", f"count-{self.collection.count()}"))
+
+    def current_version(self) -> str:
+        return self.version if self.is_loaded else self.collection_version()
+
+    def _collection_space(self) -> str:
+        try:
+            configuration = self.collection.configuration or {}
+            return (configuration.get("hnsw") or {}).get("space") or "l2"
+        except Exception:
+            return "l2"
+
+    def _cache_files(self):
+        name = self.collection.name
+        return self.cache_dir / f"{name}.npy", self.cache_dir / f"{name}.json"
+
+    def _load_from_cache(self) -> bool:
+        if self.cache_dir is None:
+            return False
+        vectors_file, meta_file = self._cache_files()
+        if not vectors_file.exists() or not meta_file.exists():
+            return False
+        with open(meta_file, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != self.version:
+            return False
+        self.ids = meta["ids"]
+        self.documents = meta["documents"]
+        self.metadatas = meta["metadatas"]
+        self.vectors = np.load(vectors_file, mmap_mode="r" if self.use_mmap else None)
+        return len(self.ids) == self.vectors.shape[0]
+
+    def _load_from_collection(self):
+        records = self.collection.get(include=["embeddings", "documents", "metadatas"])
+        self.ids = list(records["ids"])
+        self.documents = list(records["documents"])
+        self.metadatas = list(records["metadatas"])
+        self.vectors = np.ascontiguousarray(np.asarray(records["embeddings"], dtype=np.float32))
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            vectors_file, meta_file = self._cache_files()
+            vectors_temp = vectors_file.with_name(f"{vectors_file.name}.{os.getpid()}.tmp")     # every worker may rebuild it, the last one wins
+            meta_temp = meta_file.with_name(f"{meta_file.name}.{os.getpid()}.tmp")
+            with open(vectors_temp, "wb") as f:
+                np.save(f, self.vectors)
+            with open(meta_temp, "w", encoding="utf-8") as f:
+                json.dump({"version": self.version, "ids": self.ids, "documents": self.documents, "metadatas": self.metadatas}, f)
+            os.replace(vectors_temp, vectors_file)
+            os.replace(meta_temp, meta_file)        # last, the json(version) marks the cache as complete
+            if self.use_mmap:
+                self.vectors = np.load(vectors_file, mmap_mode="r")
+
+    def load(self):
+        '''Blocking. Call it once at startup(in a thread) before serving queries'''
+        self.version = self.collection_version()
+        self.space = self._collection_space()
+        if not self._load_from_cache():
+            self._load_from_collection()
+        self.sq_norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+        self.quantize(self.quantization)
+        self.row_of = {code: row for row, code in enumerate(self.ids)}
+        self.build_partitions()
+        self.is_loaded = True
+        print(f"loaded catalogue index with {len(self.ids)} vectors (version {self.version})")
+
+    def quantize(self, mode: str):
+        '''Builds the quantized copy used by the coarse scan, "none" scans the float32 vectors'''
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"quantization must be one of {QUANTIZATION_MODES}, got {mode}")
+        self.quantization = mode
+        self.quantized, self.row_scales = None, None
+        if mode == "int8":
+            self.row_scales = (np.abs(self.vectors).max(axis=1) / 127.0).astype(np.float32)
+            self.row_scales[self.row_scales == 0] = 1.0
+            self.quantized = np.empty(self.vectors.shape, dtype=np.int8)
+            for start in range(0, self.vectors.shape[0], SCAN_CHUNK):
+                block = self.vectors[start:start + SCAN_CHUNK] / self.row_scales[start:start + SCAN_CHUNK, None]
+                self.quantized[start:start + SCAN_CHUNK] = np.clip(np.rint(block), -127, 127)
+
+    def build_partitions(self):
+        groups: Dict[str, List[int]] = {}
+        numbers: Dict[str, Dict[str, int]] = {}
+        for row, (code, metadata) in enumerate(zip(self.ids, self.metadatas)):
+            division = (metadata or {}).get("division_name")
+            if not division:
+                continue
+            groups.setdefault(division, []).append(row)
+            if code[:1].isdigit():
+                counts = numbers.setdefault(code[0], {})
+                counts[division] = counts.get(division, 0) + 1
+        self.partitions = {division: np.asarray(rows, dtype=np.int64) for division, rows in groups.items()}
+        self.division_tokens = {division: set(tokenize(division)) for division in groups}
+        self.division_of_number = {number: max(counts, key=counts.get) for number, counts in numbers.items()}
+
+    def match_divisions(self, label: str, min_score: float = 0.5) -> List[str]:
+        '''
+        Divisions of the catalogue named by a label written by the llm, which doesn't always use the exact catalogue names
+        ("Service and Sales Workers" for "Service Workers and Shop & Market Sales Workers"). Every part of the label(split on "/" and "or")
+        is matched to the division with the best token overlap(dice score >= min_score), numbers are matched through the occupation codes.
+        An empty list means the label names no known division("Unknown", "Ambiguous").
+        '''
+        matched = [self.division_of_number[number] for number in DIVISION_NUMBERS.findall(label) if number in self.division_of_number]
+        for part in DIVISION_SEPARATORS.split(label):
+            tokens = set(tokenize(part))
+            if not tokens:
+                continue
+            scores = {division: 2 * len(tokens & division_tokens) / (len(tokens) + len(division_tokens)) for division, division_tokens in self.division_tokens.items() if division_tokens}
+            best = max(scores, key=scores.get, default=None)
+            if best is not None and scores[best] >= min_score:
+                matched.append(best)
+        return list(dict.fromkeys(matched))
+
+    def division_rows(self, divisions: List[str]) -> Optional[np.ndarray]:
+        '''Rows of the divisions, None when they cover the whole catalogue'''
+        rows = [self.partitions[division] for division in divisions if division in self.partitions]
+        if not rows:
+            return None
+        rows = np.sort(np.concatenate(rows)) if len(rows) > 1 else rows[0]
+        return None if rows.shape[0] == len(self.ids) else rows
+
+    def other_rows(self, rows: np.ndarray) -> np.ndarray:
+        '''Rows which are not in rows(a partition), sorted'''
+        return np.setdiff1d(np.arange(len(self.ids), dtype=np.int64), rows, assume_unique=True)
+
+    def similarity(self, distance: float) -> float:
+        '''Cosine similarity from a distance of the collection's space, the catalogue vectors are normalized'''
+        return 1.0 - distance / 2.0 if self.space == "l2" else 1.0 - distance
+
+    def memory_bytes(self) -> int:
+        '''Bytes of the matrix every scan reads, the float32 one is not counted when it is memory-mapped and only reranked'''
+        if self.quantized is not None:
+            return self.quantized.nbytes + (self.row_scales.nbytes if self.row_scales is not None else 0) + (0 if isinstance(self.vectors, np.memmap) else self.vectors.nbytes)
+        return self.vectors.nbytes
+
+    def _to_distances(self, dots: np.ndarray, query: np.ndarray, rows=None) -> np.ndarray:
+        sq_norms = self.sq_norms if rows is None else self.sq_norms[rows]
+        if self.space == "ip":
+            return 1.0 - dots
+        if self.space == "cosine":
+            return 1.0 - dots / (np.sqrt(sq_norms) * np.linalg.norm(query) + 1e-12)
+        return sq_norms - 2.0 * dots + float(query @ query)     # squared l2, same as chroma's default
+
+    def _coarse_dots(self, query: np.ndarray, rows=None) -> np.ndarray:
+        quantized = self.quantized if rows is None else self.quantized[rows]
+        dots = np.empty(quantized.shape[0], dtype=np.float32)
+        block = np.empty((min(SCAN_CHUNK, quantized.shape[0]), quantized.shape[1]), dtype=np.float32)       # per call, concurrent searches don't share it
+        for start in range(0, quantized.shape[0], SCAN_CHUNK):
+            chunk = quantized[start:start + SCAN_CHUNK]
+            np.copyto(block[:chunk.shape[0]], chunk, casting="unsafe")
+            dots[start:start + chunk.shape[0]] = block[:chunk.shape[0]] @ query
+        if self.row_scales is not None:
+            dots *= self.row_scales if rows is None else self.row_scales[rows]
+        return dots
+
+    def rescore(self, query_embedding, distances: np.ndarray, rows) -> np.ndarray:
+        '''Overwrites the distances of the rows with the exact float32 ones, only needed after a quantized scan'''
+        if self.quantized is None or len(rows) == 0:
+            return distances
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        rows = np.sort(np.asarray(rows, dtype=np.int64))      # sorted reads of the memory-mapped rows
+        distances[rows] = self._to_distances(self.vectors[rows] @ query, query, rows)
+        return distances
+
+    def distances(self, query_embedding, rows=None) -> np.ndarray:
+        '''
+        Distances of the query to every vector, using the same distance function as the chroma collection.
+        After a quantized scan the rerank_candidates closest rows have exact distances, the others are approximate.
+        With rows(a partition) only those rows are scanned, the others are at an infinite distance.
+        '''
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        if rows is None:
+            if self.quantized is None:
+                return self._to_distances(self.vectors @ query, query)
+            distances = self._to_distances(self._coarse_dots(query), query)
+        else:
+            distances = np.full(self.vectors.shape[0], np.inf, dtype=np.float32)
+            if self.quantized is None:
+                distances[rows] = self._to_distances(self.vectors[rows] @ query, query, rows)
+                return distances
+            distances[rows] = self._to_distances(self._coarse_dots(query, rows), query, rows)
+        return self.rescore(query, distances, self.top_k(distances, self.rerank_candidates))
+
+    def top_k(self, distances: np.ndarray, n_results: int) -> np.ndarray:
+        n_results = min(n_results, distances.shape[0])
+        if n_results == 0:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.argpartition(distances, n_results - 1)[:n_results]
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+        return candidates[np.isfinite(distances[candidates])]       # rows outside the scanned partition
+
+    def build_results(self, rows, distances) -> dict:
+        '''Makes the result in the same shape as chroma's collection.query so the rest of the graph doesn't change'''
+        rows = [int(row) for row in rows]
+        return {
+            "ids": [[self.ids[row] for row in rows]],
+            "embeddings": None,
+            "documents": [[self.documents[row] for row in rows]],
+            "uris": None,
+            "included": ["metadatas", "documents", "distances"],
+            "data": None,
+            "metadatas": [[self.metadatas[row] for row in rows]],
+            "distances": [[float(distances[row]) for row in rows]]
+        }
+
+    def lookup(self, ids: List[str]) -> Optional[dict]:
+        '''Documents and metadatas of the given codes in chroma's shape(without distances), None if any code is not in the index'''
+        rows = [self.row_of.get(code) for code in ids]
+        if any(row is None for row in rows):
+            return None
+        return {
+            "ids": [list(ids)],
+            "documents": [[self.documents[row] for row in rows]],
+            "metadatas": [[self.metadatas[row] for row in rows]]
+        }
+
+    def search(self, query_embedding, n_results: int = 5, rows=None) -> dict:
+        distances = self.distances(query_embedding, rows)
+        rows = self.top_k(distances, n_results)
+        return self.build_results(rows, distances)
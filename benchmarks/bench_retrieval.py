@@ -0,0 +1,133 @@
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+
+'''
+Recall and latency of the quantized catalogue scans(app/vector_index.py) against the float32 baseline.
+
+For the int8 quantization and every number of rerank candidates, the same queries are searched and compared with the exact
+float32 top-k: recall@k is the share of the exact top-k found, top1 is how often the best row is the same. The latency is the
+whole search(scan, rerank, top-k) per query and the memory is what every scan reads.
+
+The vectors are the cached catalogue(embeddings_cache/, written by the app at startup) or synthetic ones with --synthetic,
+e.g. to see how the scans grow when alternate titles or other classification schemes are added. The queries are catalogue
+vectors with noise, close to real queries which land near a few occupations.
+
+Usage(from the repo root):
+    python -m benchmarks.bench_retrieval --queries 1000 --k 5 --candidates 20,50,100
+    python -m benchmarks.bench_retrieval --synthetic 200000
+'''
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:      # also runnable as python benchmarks/bench_retrieval.py
+    sys.path.insert(0, str(ROOT))
+
+from app.vector_index import CatalogueIndex
+
+DEFAULT_CACHE = ROOT / "embeddings_cache" / "EmbeddingsV-0.2_all-MiniLM-L6-v2.npy"
+
+
+def load_vectors(args) -> np.ndarray:
+    if args.synthetic:
+        rng = np.random.default_rng(args.seed)
+        vectors = rng.standard_normal((args.synthetic, args.dim), dtype=np.float32)
+    else:
+        if not args.vectors.exists():
+            raise FileNotFoundError(f"{args.vectors} not found, start the app once to write the index cache or use --synthetic")
+        vectors = np.load(args.vectors).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12       # MiniLM embeddings are normalized
+    return np.ascontiguousarray(vectors)
+
+
+def make_queries(vectors: np.ndarray, args) -> np.ndarray:
+    rng = np.random.default_rng(args.seed + 1)
+    rows = rng.integers(0, vectors.shape[0], size=args.queries)
+    queries = vectors[rows] + rng.standard_normal((args.queries, vectors.shape[1]), dtype=np.float32) * args.noise
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def build_index(vectors: np.ndarray, quantization: str, rerank_candidates: int) -> CatalogueIndex:
+    '''Same state as CatalogueIndex.load, without a chroma collection'''
+    index = CatalogueIndex(None, quantization=quantization, rerank_candidates=rerank_candidates)
+    index.vectors = vectors
+    index.ids = [str(row) for row in range(vectors.shape[0])]
+    index.sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+    index.quantize(quantization)
+    index.is_loaded = True
+    return index
+
+
+def search_rows(index: CatalogueIndex, queries: np.ndarray, k: int):
+    results, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        rows = index.top_k(index.distances(query), k)
+        latencies.append(time.perf_counter() - started)
+        results.append(rows)
+    return results, np.asarray(latencies) * 1000
+
+
+def run(args) -> dict:
+    vectors = load_vectors(args)
+    queries = make_queries(vectors, args)
+    baseline = build_index(vectors, "none", 0)
+    exact, latencies = search_rows(baseline, queries, args.k)
+    report = {
+        "vectors": vectors.shape[0],
+        "dim": vectors.shape[1],
+        "rows": [{
+            "quantization": "none", "candidates": 0, "memory_mb": round(baseline.memory_bytes() / 2**20, 2),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3), "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "recall": 1.0, "top1": 1.0
+        }]
+    }
+    for candidates in args.candidates:
+        index = build_index(vectors, "int8", candidates)
+        found, latencies = search_rows(index, queries, args.k)
+        recall = np.mean([len(set(rows.tolist()) & set(truth.tolist())) / len(truth) for rows, truth in zip(found, exact)])
+        top1 = np.mean([rows[0] == truth[0] for rows, truth in zip(found, exact)])
+        report["rows"].append({
+            "quantization": "int8", "candidates": candidates,
+            "memory_mb": round((index.quantized.nbytes + index.row_scales.nbytes) / 2**20, 2),      # the float32 rows are read from the mmap
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3), "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "recall": round(float(recall), 4), "top1": round(float(top1), 4)
+        })
+    return report
+
+
+def print_report(report: dict, args):
+    print(f"{report['vectors']} vectors x {report['dim']}, {args.queries} queries, recall@{args.k} against the float32 scan")
+    print(f"{'quantization':<13}{'candidates':>11}{'memory_mb':>11}{'p50_ms':>9}{'p95_ms':>9}{'recall':>9}{'top1':>8}")
+    for row in report["rows"]:
+        print(f"{row['quantization']:<13}{row['candidates']:>11}{row['memory_mb']:>11}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['recall']:>9}{row['top1']:>8}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Recall vs latency of the quantized catalogue scans")
+    parser.add_argument("--vectors", type=Path, default=DEFAULT_CACHE, help="cached catalogue vectors(.npy)")
+    parser.add_argument("--synthetic", type=int, default=0, help="use this many random vectors instead of the catalogue")
+    parser.add_argument("--dim", type=int, default=384, help="dimension of the synthetic vectors")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--candidates", type=lambda value: [int(v) for v in value.split(",")], default=[20, 50, 100], help="rerank candidates, comma separated")
+    parser.add_argument("--noise", type=float, default=0.05, help="std of the noise added to catalogue vectors to make the queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    print_report(report, args)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"args": {**vars(args), "vectors": str(args.vectors)}, **report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import re
+import time
+from typing import Any, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.runnables import RunnableLambda, RunnableMap, RunnablePassthrough
+
+
+'''
+Deterministic stand-in for ChatGroq used by the benchmarks, so that load tests don't burn Groq quota.
+It answers in the same json shape as the expander and analyzer llm calls and sleeps for a fixed latency to mimic the provider.
+
+The analyzer asks for more information until the user message contains FINAL_MARKER, then it returns MATCH_FOUND
+with the first code of the retrieved results table, so a conversation is create session -> start -> resume(s).
+'''
+
+FINAL_MARKER = "that is all about my work"
+
+TOP_CODE_PATTERN = re.compile(r"^1 \| (\S+) \| ([^|]*)\|", re.MULTILINE)
+USER_INPUT_PATTERN = re.compile(r"<user_input>(.*?)</user_input>", re.DOTALL)
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeChatModel(BaseChatModel):
+
+    latency: float = 0.3            # seconds per call, roughly a Groq call of the 8b model
+    chunk_size: int = 40            # characters per streamed chunk
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-groq"
+
+    def _respond(self, messages: List[BaseMessage]) -> str:
+        system = str(messages[0].content)
+        human = str(messages[-1].content)
+        if "<user_input>" in human or "Final Arbitrator" in system:
+            match = USER_INPUT_PATTERN.search(human)
+            user_input = match.group(1) if match else human
+            top = TOP_CODE_PATTERN.search(human)
+            if FINAL_MARKER in user_input and top:
+                code, title = top.group(1), top.group(2).strip()
+                output = {
+                    "thought_process": "benchmark", "status": "MATCH_FOUND", "selected_code": code, "selected_title": title,
+                    "confidence_score": 8, "system_directive": "top retrieved result", "user_message": f"Occupation Code- {code} ({title})"
+                }
+            else:
+                output = {
+                    "thought_process": "benchmark", "status": "MORE_INFO", "selected_code": "", "selected_title": "",
+                    "confidence_score": 4, "system_directive": "need more details", "user_message": "Could you tell me more about your daily tasks?"
+                }
+        else:
+            output = {
+                "reasoning": "benchmark", "division_reason": "benchmark", "title_reason": "benchmark", "is_query_generated": True,
+                "query": f"Division: Unknown | Title: Worker | Description: {' '.join(human.split()[-40:])}",
+                "note_for_analyzer": "", "clarification_question": ""
+            }
+        return json.dumps(output)
+
+    def _message(self, messages: List[BaseMessage], content: str) -> AIMessage:
+        prompt_tokens = sum(_tokens(str(msg.content)) for msg in messages)
+        completion_tokens = _tokens(content)
+        return AIMessage(content=content, usage_metadata={
+            "input_tokens": prompt_tokens, "output_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens
+        })
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages, self._respond(messages)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages, self._respond(messages)))])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any):
+        content = self._respond(messages)
+        pieces = [content[i:i + self.chunk_size] for i in range(0, len(content), self.chunk_size)]
+        for piece in pieces:
+            await asyncio.sleep(self.latency / len(pieces))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    def with_structured_output(self, schema, *, method: str = "json_mode", include_raw: bool = False, **kwargs: Any):
+        '''Same output shape as ChatGroq in json_mode, {"raw", "parsed", "parsing_error"} when include_raw'''
+        parser = JsonOutputParser()
+        if not include_raw:
+            return self | parser
+        return RunnableMap(raw=self) | RunnablePassthrough.assign(
+            parsed=RunnableLambda(lambda x: parser.invoke(x["raw"])),
+            parsing_error=RunnableLambda(lambda _: None)
+        )
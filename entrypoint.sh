@@ -3,5 +3,10 @@ set -e
 
 echo "Starting container..."
 
+if [ "${SERVER_MODE:-single}" = "workers" ]; then
+    echo "Starting API with ${WEB_CONCURRENCY:-$(nproc)} workers..."
+    exec gunicorn -c gunicorn.conf.py app.main:app
+fi
+
 echo "Starting API..."
 exec uvicorn app.main:app --host 0.0.0.0 --port 8000
@@ -69,6 +69,89 @@ async function apiCall(path, options = {}) {
     return response.json();
 }
 
+/* ---------------- STREAMING API ---------------- */
+const PROGRESS_TEXT = {
+    expander: "Understanding your job description…",
+    retrieval: "Searching NCO-2015 occupations…",
+    analyzer: "Analyzing the best match…",
+    token: "Analyzing the best match…"
+};
+
+function parseSseFrame(frame) {
+    let event = "message";
+    const dataLines = [];
+    frame.split("\n").forEach(line => {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+    });
+    if (dataLines.length === 0) return null;
+    return { event, data: JSON.parse(dataLines.join("\n")) };
+}
+
+// fetch is used instead of EventSource because the chat endpoints need PUT, a body and the Session-Id header
+async function streamCall(path, body, onEvent) {
+    let response;
+
+    try {
+        response = await fetch(`${API_BASE}${path}`, {
+            method: "PUT",
+            headers: {
+                "Content-Type": "application/json",
+                "Accept": "text/event-stream",
+                "Session-Id": state.sessionId || ""
+            },
+            body: JSON.stringify(body)
+        });
+    } catch {
+        throw { detail: "NETWORK_ERROR", error_message: "Network error" };
+    }
+
+    if (!response.ok) {
+        let errBody = {};
+        try {
+            errBody = await response.json();
+        } catch {}
+
+        throw {
+            detail: errBody.detail,
+            error_message: errBody.error_message || "Request failed"
+        };
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let result = null;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+            const parsed = parseSseFrame(buffer.slice(0, boundary));
+            buffer = buffer.slice(boundary + 2);
+            if (!parsed) continue;
+
+            if (parsed.event === "error") throw { detail: parsed.data };
+            if (parsed.event === "result") result = parsed.data;
+            else onEvent(parsed.event, parsed.data);
+        }
+    }
+
+    if (!result) {
+        throw { detail: "NETWORK_ERROR", error_message: "Stream ended before the result" };
+    }
+    return result;
+}
+
+function showProgress(event) {
+    if (PROGRESS_TEXT[event]) {
+        loader.textContent = PROGRESS_TEXT[event];
+    }
+}
+
 /* ---------------- ERROR HANDLER ---------------- */
 function handleError(err) {
 
@@ -152,15 +235,12 @@ async function sendMessage(text) {
     setProcessing(true);
 
     try {
-        const endpoint = state.mode === "resume" ? "/resume" : "/start";
+        const endpoint = state.mode === "resume" ? "/resume/stream" : "/start/stream";
 
-        const data = await apiCall(endpoint, {
-            method: "PUT",
-            body: JSON.stringify({
-                thread_id: state.threadId,
-                user_message: text
-            })
-        });
+        const data = await streamCall(endpoint, {
+            thread_id: state.threadId,
+            user_message: text
+        }, showProgress);
 
         addMessage("bot", data.result);
 
@@ -214,6 +294,7 @@ function enableInput(on) {
 
 function setProcessing(on) {
     state.isProcessing = on;
+    loader.textContent = "Processing…";
     loader.classList.toggle("hidden", !on);
     enableInput(!on);
 }
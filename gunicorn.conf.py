@@ -0,0 +1,32 @@
+import os
+import multiprocessing
+
+
+'''
+Multi-worker mode(SERVER_MODE=workers in entrypoint.sh): gunicorn -c gunicorn.conf.py app.main:app
+The app is imported once in the parent(preload_app) and the read-only catalogue is loaded there before forking, so the
+workers share its pages copy-on-write(the vectors are memory-mapped from the index cache) instead of each loading its own copy.
+Everything which is not fork-safe(onnxruntime session, chroma client, database connections, the event loop) is created in the workers.
+'''
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))     # the streaming endpoints can take a while on slow llm calls
+graceful_timeout = 30       # lets the lifespan flush the heartbeats and save the query cache
+keepalive = 5
+
+# each worker runs its own embedding model, without a limit every worker would start a thread per core
+os.environ.setdefault("ONNX_INTRA_OP_THREADS", str(max(1, multiprocessing.cpu_count() // workers)))
+
+
+def when_ready(server):
+    from app import utils
+    utils.preload_shared()
+    server.log.info("catalogue preloaded in the parent, forking %s workers", workers)
+
+
+def post_fork(server, worker):
+    from app import utils
+    utils.reopen_after_fork()
@@ -1,3 +1,12 @@
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 import pandas as pd
 import chromadb
 from chromadb.utils import embedding_functions
@@ -10,48 +19,202 @@ from pathlib import Path
 '''
 The dataset has 6 columns- code, title, family_name, division_name, description, final_title.
 final_title is the column derived from columns - division_name, title and description.This column is used for embeddings.Other columns are used for metadata.
+
+The collection is updated incrementally: every row gets a content_hash of its final_title and metadata(stored in the metadata),
+only new or changed occupations are embedded and upserted, codes which are not in the dataset anymore are deleted.
+The catalogue_version written in the collection metadata is a hash of all the (code, content_hash) pairs, the in-process
+vector index(app/vector_index.py) uses it to know when its cache is stale.
+
+The embeddings are computed before they are loaded: the documents are split in shards embedded by a pool of processes, each with
+its own onnxruntime session(app/embedding.py, the same all-MiniLM-L6-v2 as the collection) limited to a few threads, which write
+their rows into one memory-mapped .npy. The vectors are then upserted with the documents in batches as big as chroma allows.
 '''
 
-DATASET_PATH=Path( Path(__file__).resolve().parent / "EmbeddingsV-0.2.csv" ) 
-if not DATASET_PATH.exists():
-    raise FileNotFoundError(f"Dataset not found at {DATASET_PATH}")
+DATASET_PATH=Path( Path(__file__).resolve().parent / "EmbeddingsV-0.2.csv" )
+COLLECTION_NAME="EmbeddingsV-0.2_all-MiniLM-L6-v2"
+METADATA_COLUMNS={         # dataset column -> metadata key
+    "code": "occupation_code",
+    "family_name": "family_name",
+    "division_name": "division_name",
+    "title": "occupation_title"
+}
+
 
-df9=pd.read_csv(DATASET_PATH)  # Download the dataset and add it in the current project folder
+def load_dataset(dataset_path: Path) -> pd.DataFrame:
+    if not dataset_path.exists():
+        raise FileNotFoundError(f"Dataset not found at {dataset_path}")
+    df9=pd.read_csv(dataset_path)  # Download the dataset and add it in the current project folder. codes are parsed as numbers, as when the collection was first built
+    if df9['code'].duplicated().any():
+        raise ValueError(f"Duplicate codes in the dataset: {df9.loc[df9['code'].duplicated(), 'code'].tolist()[:10]}")
+    return df9
 
-def get_metadata(df_row):
+
+def get_metadatas(df9: pd.DataFrame) -> list:
     '''Make the metadata for the embeddings having code, family_name, division_name, title'''
-    
-    return {
-        "occupation_code": df_row['code'],
-        "family_name": df_row['family_name'],
-        "division_name": df_row['division_name'],
-        "occupation_title": df_row['title']
-    }
-documents=df9['final_title'].to_list()
-metadatas=df9.apply(get_metadata, axis=1).to_list()
-ids=df9['code'].astype(str).to_list()
-
-print(str(EMBEDDINGS_PATH))
-
-client=chromadb.PersistentClient(str(EMBEDDINGS_PATH))
-default_ef=embedding_functions.DefaultEmbeddingFunction()
-collection=client.create_collection(name="EmbeddingsV-0.2_all-MiniLM-L6-v2", embedding_function=default_ef)
-
-def batch_add(collection, documents, metadatas, ids, batch_size=500):
+    return df9[list(METADATA_COLUMNS)].rename(columns=METADATA_COLUMNS).to_dict("records")
+
+
+def content_hash(document: str, metadata: dict) -> str:
+    payload = json.dumps([document, metadata], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def catalogue_version(hashes: dict) -> str:
+    digest = hashlib.sha256()
+    for code in sorted(hashes):
+        digest.update(f"{code}:{hashes[code]}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def catalogue_ids(df9: pd.DataFrame) -> list:
+    '''ids in the format of the existing collections: str of the parsed code(2221.0100 -> "2221.01"), the same as occupation_code shows'''
+    return df9['code'].astype(str).to_list()
+
+
+def stored_hashes(stored: dict):
+    '''
+    code -> content_hash of the rows in the collection, and the codes stored before the hashes were added. Their hash is computed
+    from the stored document and metadata, so an unchanged legacy row only gets its content_hash written instead of being embedded again.
+    '''
+    existing, legacy = {}, []
+    for code, document, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"]):
+        metadata = metadata or {}
+        if "content_hash" in metadata:
+            existing[code] = metadata["content_hash"]
+        else:
+            existing[code] = content_hash(document, metadata)
+            legacy.append(code)
+    return existing, legacy
+
+
+def diff_catalogue(ids: list, hashes: list, existing: dict):
+    '''Returns the row positions to upsert(new, changed) and the codes to delete, existing is code -> stored content_hash'''
+    new = [position for position, code in enumerate(ids) if code not in existing]
+    changed = [position for position, (code, row_hash) in enumerate(zip(ids, hashes)) if code in existing and existing[code] != row_hash]
+    removed = sorted(set(existing) - set(ids))
+    return new, changed, removed
+
+
+_embedder=None      # per worker process
+
+
+def _init_worker(threads: int):
+    global _embedder
+    from app.embedding import QueryEmbedder
+    _embedder=QueryEmbedder(intra_op_threads=threads)
+
+
+def _embed_shard(vectors_path: str, start: int, documents: list) -> int:
+    vectors=np.lib.format.open_memmap(vectors_path, mode="r+")
+    vectors[start:start+len(documents)]=np.asarray(_embedder(documents), dtype=np.float32)
+    vectors.flush()
+    return len(documents)
+
+
+def embed_documents(documents: list, vectors_path: str, workers: int, threads: int, shard_size: int = 256) -> np.ndarray:
+    '''Embeds the documents into a memory-mapped (len(documents), dim) array at vectors_path, shards run on a pool of workers processes'''
+    from app.embedding import QueryEmbedder
+    probe=QueryEmbedder(intra_op_threads=1)
+    probe.download()          # once, before the workers start
+    dimension=len(probe(["dimension probe"])[0])
+    vectors=np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32, shape=(len(documents), dimension))
+    del vectors
+
+    shards=[(start, documents[start:start+shard_size]) for start in range(0, len(documents), shard_size)]
+    started=time.perf_counter()
+    with tqdm(total=len(documents), unit="docs") as progress:
+        if workers <= 1:
+            _init_worker(threads)
+            for start, shard in shards:
+                progress.update(_embed_shard(vectors_path, start, shard))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"), initializer=_init_worker, initargs=(threads,)) as pool:      # onnxruntime is not fork-safe
+                futures=[pool.submit(_embed_shard, vectors_path, start, shard) for start, shard in shards]
+                for future in as_completed(futures):
+                    progress.update(future.result())
+    seconds=time.perf_counter() - started
+    print(f"embedded {len(documents)} documents in {seconds:.1f}s ({len(documents) / max(seconds, 1e-9):.0f} docs/sec, {workers} workers x {threads} threads)")
+    return np.load(vectors_path, mmap_mode="r")
+
+
+def batch_upsert(collection, documents, metadatas, ids, embeddings, batch_size=500):
     total_docs=len(documents)
-    for i in tqdm(range(0, total_docs, batch_size)):
-        batch_docs=documents[i:i+batch_size]
-        batch_meta=metadatas[i:i+batch_size]
-        batch_ids=ids[i:i+batch_size]
-
-        collection.add(
-            documents=batch_docs,
-            metadatas=batch_meta,
-            ids=batch_ids
+    started=time.perf_counter()
+    for i in range(0, total_docs, batch_size):
+        collection.upsert(
+            documents=documents[i:i+batch_size],
+            metadatas=metadatas[i:i+batch_size],
+            ids=ids[i:i+batch_size],
+            embeddings=np.ascontiguousarray(embeddings[i:i+batch_size])
         )
-    print("added documents")
-    
-if collection.count() == 0:
-    batch_add(collection, documents, metadatas, ids)
-else:
-    print(f"Collection already contains {collection.count()} documents.")
\ No newline at end of file
+    print(f"loaded {total_docs} documents in {time.perf_counter() - started:.1f}s")
+
+
+def batch_update_metadatas(collection, metadatas, ids, batch_size=500):
+    for i in range(0, len(ids), batch_size):
+        collection.update(ids=ids[i:i+batch_size], metadatas=metadatas[i:i+batch_size])     # no documents, nothing is embedded
+
+
+def batch_delete(collection, ids, batch_size=500):
+    for i in range(0, len(ids), batch_size):
+        collection.delete(ids=ids[i:i+batch_size])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embeds the NCO dataset into the chroma collection, only what changed since the last run")
+    parser.add_argument("--dataset", type=Path, default=DATASET_PATH)
+    parser.add_argument("--dry-run", action="store_true", help="only print the diff")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="embedding processes")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="onnxruntime threads of every process, defaults to cores / workers")
+    args = parser.parse_args()
+
+    df9=load_dataset(args.dataset)
+    documents=df9['final_title'].to_list()
+    metadatas=get_metadatas(df9)
+    ids=catalogue_ids(df9)
+    hashes=[content_hash(document, metadata) for document, metadata in zip(documents, metadatas)]
+    for metadata, row_hash in zip(metadatas, hashes):
+        metadata["content_hash"]=row_hash
+
+    print(str(EMBEDDINGS_PATH))
+    client=chromadb.PersistentClient(str(EMBEDDINGS_PATH))
+    default_ef=embedding_functions.DefaultEmbeddingFunction()
+    collection=client.get_or_create_collection(name=COLLECTION_NAME, embedding_function=default_ef)
+
+    stored=collection.get(include=["metadatas", "documents"])
+    existing, legacy=stored_hashes(stored)
+    new, changed, removed=diff_catalogue(ids, hashes, existing)
+    unchanged=len(ids) - len(new) - len(changed)
+    upserted=set(new + changed)
+    position_of={code: position for position, code in enumerate(ids)}
+    backfill=[position_of[code] for code in legacy if code in position_of and position_of[code] not in upserted]
+    version=catalogue_version(dict(zip(ids, hashes)))
+    print(f"catalogue {version}: {len(new)} new, {len(changed)} changed, {len(removed)} removed, {unchanged} unchanged({len(backfill)} get their content_hash)")
+    if changed:
+        print("changed:", ", ".join(ids[position] for position in changed[:20]), "..." if len(changed) > 20 else "")
+    if removed:
+        print("removed:", ", ".join(removed[:20]), "..." if len(removed) > 20 else "")
+    if args.dry_run:
+        return
+
+    upserts=sorted(new + changed)
+    if upserts:
+        workers=max(1, min(args.workers, -(-len(upserts) // 256)))      # no more workers than shards
+        threads=args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        upsert_documents=[documents[p] for p in upserts]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            vectors=embed_documents(upsert_documents, os.path.join(tmp_dir, "vectors.npy"), workers, threads)
+            batch_upsert(collection, upsert_documents, [metadatas[p] for p in upserts], [ids[p] for p in upserts], vectors, batch_size=client.get_max_batch_size())
+            del vectors
+    if backfill:
+        batch_update_metadatas(collection, [metadatas[p] for p in backfill], [ids[p] for p in backfill], batch_size=client.get_max_batch_size())
+    if removed:
+        batch_delete(collection, removed)
+    collection_metadata={key: value for key, value in (collection.metadata or {}).items() if not key.startswith("hnsw:")}
+    if collection_metadata.get("catalogue_version") != version:
+        collection.modify(metadata={**collection_metadata, "catalogue_version": version})
+    print(f"collection has {collection.count()} documents (catalogue_version {version})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import pytest
+from pathlib import Path
+
+
+'''
+The tests import the app modules without the hosted databases or Groq, nothing connects at import time.
+The required settings get placeholder values(same as benchmarks/bench_chat.py) and fake_db stands in for the user-database sessions.
+'''
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+PLACEHOLDER_SETTINGS = {
+    "CHECKPOINTER_DB_PASSWORD": "test", "CHECKPOINTER_DB_HOST": "localhost", "CHECKPOINTER_DB_USERNAME": "test", "CHECKPOINTER_DB_DBNAME": "test",
+    "DATABASE_PASSWORD": "test", "DATABASE_REGION": "test", "DATABASE_HOST": "test", "DATABASE_NAME": "test",
+    "GROQ_API_KEY": "test", "LANGSMITH_TRACING": "false", "LANGSMITH_ENDPOINT": "http://localhost", "LANGSMITH_API_KEY": "test",
+    "LANGSMITH_PROJECT": "test", "ALLOWED_URL1": "http://localhost", "ALLOWED_URL2": "http://localhost", "ALLOWED_URL3": "http://localhost",
+    "QUERY_CACHE_PERSIST": "false"
+}
+for key, value in PLACEHOLDER_SETTINGS.items():
+    os.environ.setdefault(key, value)
+
+
+class FakeResult:
+
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def all(self) -> list:
+        return self.rows
+
+
+class FakeSession:
+
+    def __init__(self, database: "FakeDatabase"):
+        self.database = database
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement, params=None):
+        self.database.executed.append((statement, params))
+        if self.database.on_execute is not None:
+            self.database.on_execute(statement, params)
+        responses = self.database.responses.get(statement)
+        return FakeResult(responses.pop(0) if responses else [])
+
+    async def commit(self):
+        self.database.commits += 1
+
+
+class FakeDatabase:
+
+    '''Stands in for AsyncSessionLocal: records the executed statements and answers each one with its queued rows'''
+
+    def __init__(self):
+        self.executed = []
+        self.responses = {}         # statement -> list of row lists, one per execution
+        self.commits = 0
+        self.on_execute = None      # called with (statement, params) before answering, may raise
+
+    def __call__(self) -> FakeSession:
+        return FakeSession(self)
+
+    def params_of(self, statement) -> list:
+        return [params for executed, params in self.executed if executed is statement]
+
+
+@pytest.fixture
+def fake_db(monkeypatch) -> FakeDatabase:
+    database = FakeDatabase()
+    for module in ("app.heartbeat", "app.reaper", "app.deletion_queue"):
+        monkeypatch.setattr(f"{module}.AsyncSessionLocal", database)
+    return database
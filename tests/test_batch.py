@@ -0,0 +1,97 @@
+import asyncio
+import random
+import pytest
+from langchain_core.messages import AIMessage
+from app import batch
+from app.batch import BatchInputError, parse_rows, run_batch
+from app.src.schemas import AnalyzerOutput
+
+
+def test_parse_csv_rows_with_ids_and_default_row_numbers():
+    rows = parse_rows("id,description\nr1, I drive a taxi \n,I am a nurse\n", "csv")
+    assert rows == [{"id": "r1", "description": "I drive a taxi"}, {"id": "1", "description": "I am a nurse"}]
+
+
+def test_parse_ndjson_rows_with_any_text_field():
+    content = '{"id": 7, "text": "I cook"}\n\n{"job_description": "I teach"}\n{"user_message": null}\n'
+    assert parse_rows(content, "ndjson") == [
+        {"id": "7", "description": "I cook"},
+        {"id": "1", "description": "I teach"},
+        {"id": "2", "description": ""}
+    ]
+
+
+@pytest.mark.parametrize("content, input_format, message", [
+    ("id,name\n1,x\n", "csv", "none of the columns"),
+    ('{"description": "a"}\nnot json\n', "ndjson", "invalid json line"),
+    ('["a list"]\n', "ndjson", "is not an object"),
+    ("description\na\n", "xlsx", "unknown format")
+])
+def test_parse_rows_rejects_bad_input(content, input_format, message):
+    with pytest.raises(BatchInputError, match=message):
+        parse_rows(content, input_format)
+
+
+@pytest.fixture
+def fake_classify(monkeypatch):
+    '''Rows finish in random order, the description "boom" fails'''
+    started = []
+
+    async def classify(description: str) -> dict:
+        started.append(description)
+        await asyncio.sleep(random.uniform(0, 0.01))
+        if description == "boom":
+            raise RuntimeError("llm failed")
+        return {"status": "MATCH_FOUND", "result": description.upper()}
+
+    monkeypatch.setattr(batch, "classify", classify)
+    return started
+
+
+def collect(rows, concurrency, start_at=0):
+    async def run():
+        return [result async for result in run_batch(rows, concurrency, start_at)]
+    return asyncio.run(run())
+
+
+def test_run_batch_yields_results_in_input_order(fake_classify):
+    rows = [{"id": f"r{index}", "description": f"row {index}"} for index in range(30)]
+    results = collect(rows, concurrency=4)
+    assert [result["index"] for result in results] == list(range(30))
+    assert [result["id"] for result in results] == [row["id"] for row in rows]
+    assert results[3]["result"] == "ROW 3"
+
+
+def test_run_batch_resumes_at_start_at(fake_classify):
+    rows = [{"id": f"r{index}", "description": f"row {index}"} for index in range(10)]
+    results = collect(rows, concurrency=3, start_at=6)
+    assert [result["index"] for result in results] == [6, 7, 8, 9]
+    assert sorted(fake_classify) == ["row 6", "row 7", "row 8", "row 9"]       # the rows already received are not classified again
+
+
+def test_run_batch_reports_a_failed_row_and_continues(fake_classify):
+    rows = [{"id": "a", "description": "ok"}, {"id": "b", "description": "boom"}, {"id": "c", "description": "fine"}]
+    results = collect(rows, concurrency=2)
+    assert [result["status"] for result in results] == ["MATCH_FOUND", "ERROR", "MATCH_FOUND"]
+    assert results[1]["result"] == "llm failed"
+
+
+def test_classify_returns_the_selected_code_and_title(monkeypatch):
+    class FakeGraph:
+        def __init__(self, analyzer_response):
+            self.analyzer_response = analyzer_response
+
+        async def ainvoke(self, state, config=None):
+            assert config == {"configurable": {"batch": True}}
+            return {"analyzer_response": self.analyzer_response, "messages": [AIMessage(content="Occupation Code- 8322.0100 (Taxi Driver)")]}
+
+    matched = AnalyzerOutput(thought_process="-", status="MATCH_FOUND", selected_code="8322.0100", selected_title="Taxi Driver", confidence_score=8, system_directive="-")
+    monkeypatch.setattr(batch.graph, "get_batch_graph", lambda: FakeGraph(matched))
+    assert asyncio.run(batch.classify("I drive a taxi")) == {
+        "status": "MATCH_FOUND", "result": "Occupation Code- 8322.0100 (Taxi Driver)", "code": "8322.0100", "title": "Taxi Driver", "confidence": 8
+    }
+
+    more_info = AnalyzerOutput(thought_process="-", status="MORE_INFO", confidence_score=2, system_directive="-", user_message="Which vehicle do you drive?")
+    monkeypatch.setattr(batch.graph, "get_batch_graph", lambda: FakeGraph(more_info))
+    assert asyncio.run(batch.classify("I drive")) == {"status": "UNRESOLVED", "result": "Which vehicle do you drive?"}
+    assert asyncio.run(batch.classify("")) == {"status": "UNRESOLVED", "result": "Empty description."}
@@ -0,0 +1,79 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+from app import checkpoint_store
+from app.deletion_queue import BASE_BACKOFF, CLAIM_DUE, MAX_BACKOFF, RECORD_ERROR, REMOVE_DONE, DeletionQueue
+
+
+def pending_rows(count: int) -> list:
+    return [SimpleNamespace(thread_id=uuid.uuid4()) for _ in range(count)]
+
+
+def test_poll_claims_due_rows_with_the_backoff_until_a_batch_is_short(fake_db, monkeypatch):
+    deleted_batches = []
+
+    async def delete_threads(thread_ids, concurrency):
+        deleted_batches.append(thread_ids)
+        return len(thread_ids)
+
+    monkeypatch.setattr(checkpoint_store, "delete_threads", delete_threads)
+    batches = [pending_rows(2), pending_rows(1)]
+    fake_db.responses[CLAIM_DUE] = [list(batch) for batch in batches]
+    queue = DeletionQueue(batch_size=2)
+
+    assert asyncio.run(queue.poll_once()) == 3
+    assert fake_db.params_of(CLAIM_DUE) == [{"batch_size": 2, "base_backoff": BASE_BACKOFF, "max_backoff": MAX_BACKOFF}] * 2     # claiming pushes next_attempt_at forward
+    assert deleted_batches == [[str(row.thread_id) for row in batch] for batch in batches]
+    assert fake_db.params_of(REMOVE_DONE) == [{"thread_ids": [row.thread_id for row in batch]} for batch in batches]
+    assert queue.deleted == 3 and queue.failed == 0
+
+
+def test_failed_delete_keeps_the_row_with_its_error_and_the_next_poll_retries_it(fake_db, monkeypatch):
+    attempts = []
+
+    async def delete_threads(thread_ids, concurrency):
+        attempts.append(thread_ids)
+        if len(attempts) == 1:
+            raise ConnectionError("checkpointer is down")
+        return 4
+
+    monkeypatch.setattr(checkpoint_store, "delete_threads", delete_threads)
+    row = pending_rows(1)[0]
+    fake_db.responses[CLAIM_DUE] = [[row], [], [row]]       # the row is not due again until its backoff is over
+    queue = DeletionQueue(batch_size=10)
+
+    assert asyncio.run(queue.poll_once()) == 1
+    assert fake_db.params_of(RECORD_ERROR) == [{"thread_ids": [row.thread_id], "error": "checkpointer is down"}]
+    assert fake_db.params_of(REMOVE_DONE) == []
+    assert queue.failed == 1 and queue.deleted == 0
+
+    assert asyncio.run(queue.poll_once()) == 0
+    assert asyncio.run(queue.poll_once()) == 1
+    assert attempts == [[str(row.thread_id)]] * 2
+    assert fake_db.params_of(REMOVE_DONE) == [{"thread_ids": [row.thread_id]}]
+    assert queue.failed == 1 and queue.deleted == 1
+
+
+def test_drain_deletes_the_closes_that_piled_up_in_one_batch(fake_db, monkeypatch):
+    deleted_batches = []
+
+    async def delete_threads(thread_ids, concurrency):
+        deleted_batches.append(thread_ids)
+        return len(thread_ids)
+
+    monkeypatch.setattr(checkpoint_store, "delete_threads", delete_threads)
+    thread_ids = [str(uuid.uuid4()) for _ in range(3)]
+
+    async def scenario():
+        queue = DeletionQueue(batch_size=10)
+        for thread_id in thread_ids:
+            queue.enqueue(thread_id)
+        drain = asyncio.create_task(queue._drain())
+        await asyncio.sleep(0.01)
+        drain.cancel()
+        await asyncio.gather(drain, return_exceptions=True)
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert deleted_batches == [thread_ids]
+    assert queue.deleted == 3
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from app import utils
+from app.vector_index import CatalogueIndex
+
+
+DIVISIONS = {
+    "1": "Legislators, Senior Officials and Managers",
+    "2": "Professionals",
+    "3": "Technicians and Associate Professionals",
+    "4": "Clerks",
+    "5": "Service Workers and Shop & Market Sales Workers",
+    "7": "Craft and Related Trades Workers",
+    "9": "Elementary Occupations"
+}
+ROWS_PER_DIVISION = 20
+
+
+def make_index(quantization: str = "none") -> CatalogueIndex:
+    '''Same state as CatalogueIndex.load, with random normalized vectors and ROWS_PER_DIVISION occupations per division'''
+    ids = [f"{number}{row:03d}.0100" for number in DIVISIONS for row in range(ROWS_PER_DIVISION)]
+    vectors = np.random.default_rng(0).standard_normal((len(ids), 16)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index = CatalogueIndex(None, quantization=quantization, rerank_candidates=10)
+    index.ids = ids
+    index.documents = [f"Division: {DIVISIONS[code[0]]} | Title: {code} | Description: -" for code in ids]
+    index.metadatas = [{"division_name": DIVISIONS[code[0]], "occupation_title": code} for code in ids]
+    index.vectors = vectors
+    index.sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+    index.quantize(quantization)
+    index.row_of = {code: row for row, code in enumerate(ids)}
+    index.build_partitions()
+    index.is_loaded = True
+    return index
+
+
+@pytest.fixture
+def index(monkeypatch):
+    index = make_index()
+    monkeypatch.setattr(utils, "catalogue_index", index)
+    monkeypatch.setattr(utils.lexical_index, "is_loaded", False)
+    return index
+
+
+@pytest.mark.parametrize("label, divisions", [
+    ("Craft and Related Trades Workers", ["Craft and Related Trades Workers"]),
+    ("Service and Sales Workers", ["Service Workers and Shop & Market Sales Workers"]),
+    ("Associate Professionals", ["Technicians and Associate Professionals"]),
+    ("Professionals", ["Professionals"]),
+    ("Legislators, Senior Officials, and Managers", ["Legislators, Senior Officials and Managers"]),
+    ("Div 4", ["Clerks"]),
+    ("Professionals / Associate Professionals", ["Professionals", "Technicians and Associate Professionals"]),
+    ("Div 2, 7, or 9", ["Professionals", "Craft and Related Trades Workers", "Elementary Occupations"]),
+    ("Unknown", []),
+    ("Ambiguous", []),
+    ("Div 6", [])       # no occupation code of the catalogue starts with 6
+])
+def test_match_divisions(index, label, divisions):
+    assert index.match_divisions(label) == divisions
+
+
+def test_query_division_rows(index):
+    rows = utils.query_division_rows("Division: Clerks | Title: Stock Clerk | Description: Keeps the stock registers.")
+    assert [index.ids[row][0] for row in rows] == ["4"] * ROWS_PER_DIVISION
+    both = utils.query_division_rows("Division: Professionals or Clerks | Title: Accountant")
+    assert sorted({index.ids[row][0] for row in both}) == ["2", "4"]
+    assert np.all(np.diff(both) > 0)
+
+
+def test_query_division_rows_is_none_without_a_known_division(index):
+    assert utils.query_division_rows("Division: Unknown | Title: Worker | Description: -") is None
+    assert utils.query_division_rows("I cook in a roadside restaurant") is None
+    assert utils.query_division_rows(f"Division: {' / '.join(DIVISIONS.values())} | Title: x") is None      # every division is the whole catalogue
+
+
+@pytest.mark.parametrize("quantization", ["none", "int8"])
+def test_partition_search_only_returns_rows_of_the_division(quantization):
+    index = make_index(quantization)
+    rows = index.division_rows(["Clerks"])
+    results = index.search(index.vectors[0], n_results=5, rows=rows)
+    assert [code[0] for code in results["ids"][0]] == ["4"] * 5
+    assert len(index.search(index.vectors[0], n_results=50, rows=rows)["ids"][0]) == ROWS_PER_DIVISION
+
+
+def test_division_search_outcomes(index, monkeypatch):
+    query = index.vectors[index.row_of["7005.0100"]]
+    results, outcome = utils.division_search("Division: Craft and Related Trades Workers | Title: x", query, 5)
+    assert outcome == "partition"
+    assert results["ids"][0][0] == "7005.0100" and all(code[0] == "7" for code in results["ids"][0])
+
+    global_results = utils.index_search("x", query, 5)
+    monkeypatch.setattr(utils.settings, "division_min_similarity", 1.1)      # no hit of the division is good enough
+    results, outcome = utils.division_search("Division: Clerks | Title: x", query, 5)
+    assert outcome == "low_similarity"
+    assert results["ids"] == global_results["ids"]
+    assert np.allclose(results["distances"][0], global_results["distances"][0])
+
+    _, outcome = utils.division_search("Division: Clerks | Title: x", query, ROWS_PER_DIVISION + 1)
+    assert outcome == "few_results"
+    _, outcome = utils.division_search("Division: Unknown | Title: x", query, 5)
+    assert outcome == "no_division"
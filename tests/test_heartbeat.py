@@ -0,0 +1,53 @@
+import asyncio
+import uuid
+from datetime import timedelta
+import pytest
+from app.heartbeat import FLUSH_STATEMENT, HeartbeatBuffer
+
+
+def test_flush_writes_the_latest_heartbeat_of_every_session_in_one_statement(fake_db):
+    buffer = HeartbeatBuffer()
+    first, second = uuid.uuid4(), uuid.uuid4()
+    buffer.touch(first)
+    buffer.touch(second)
+    buffer.touch(first)
+    latest = dict(buffer.pending)
+
+    assert asyncio.run(buffer.flush()) == 2
+    assert fake_db.params_of(FLUSH_STATEMENT) == [{"session_ids": [first, second], "last_used_at": [latest[first], latest[second]]}]
+    assert fake_db.commits == 1
+    assert buffer.pending == {} and buffer.flushed == 2
+    assert asyncio.run(buffer.flush()) == 0 and len(fake_db.executed) == 1       # nothing pending, no round trip
+
+
+def test_failed_flush_requeues_the_batch_without_overwriting_newer_heartbeats(fake_db):
+    buffer = HeartbeatBuffer()
+    touched_during_flush, only_in_batch = uuid.uuid4(), uuid.uuid4()
+    buffer.touch(touched_during_flush)
+    buffer.touch(only_in_batch)
+    batch = dict(buffer.pending)
+
+    def fail(statement, params):
+        buffer.pending[touched_during_flush] = batch[touched_during_flush] + timedelta(seconds=3)     # a request came in meanwhile
+        raise ConnectionError("user-database is down")
+
+    fake_db.on_execute = fail
+    with pytest.raises(ConnectionError):
+        asyncio.run(buffer.flush())
+    assert buffer.pending == {touched_during_flush: batch[touched_during_flush] + timedelta(seconds=3), only_in_batch: batch[only_in_batch]}
+    assert buffer.flushed == 0
+
+    fake_db.on_execute = None
+    assert asyncio.run(buffer.flush()) == 2 and buffer.pending == {}
+
+
+def test_stop_flushes_what_is_pending(fake_db):
+    async def scenario():
+        buffer = HeartbeatBuffer(interval=3600)
+        buffer.start()
+        buffer.touch(uuid.uuid4())
+        await buffer.stop()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert buffer.task is None and buffer.pending == {} and buffer.flushed == 1
@@ -0,0 +1,67 @@
+import numpy as np
+from app.lexical_index import LexicalIndex, reciprocal_rank_fusion, tokenize
+
+
+DOCUMENTS = [
+    "Division: Elementary Occupations | Title: Dhobi | Description: Washes and irons clothes by hand.",
+    "Division: Craft and Related Trades Workers | Title: Plumber | Description: Installs and repairs pipes and fittings.",
+    "Division: Service Workers and Shop & Market Sales Workers | Title: Anganwadi Worker | Description: Looks after young children in a village centre.",
+    "Division: Plant and Machine Operators and Assemblers | Title: Taxi Driver | Description: Drives a taxi to carry passengers.",
+    "Division: Craft and Related Trades Workers | Title: Pipe Fitter | Description: Cuts, threads and joins pipes in industrial plants, pipes pipes."
+]
+METADATAS = [
+    {"occupation_title": "Dhobi"},
+    {"occupation_title": "Plumber"},
+    {"occupation_title": "Anganwadi Worker"},
+    {"occupation_title": "Taxi Driver"},
+    {"occupation_title": "Pipe Fitter"}
+]
+
+
+def build_index(tmp_path=None) -> LexicalIndex:
+    index = LexicalIndex(cache_dir=tmp_path)
+    index.load("catalogue", "v1", DOCUMENTS, METADATAS)
+    return index
+
+
+def test_reciprocal_rank_fusion_sums_the_reciprocal_ranks():
+    fused = reciprocal_rank_fusion([[1, 2, 3], [3, 1]], k=60)
+    assert fused == [1, 3, 2]       # 1: 1/61 + 1/62, 3: 1/63 + 1/61, 2: 1/62
+
+
+def test_reciprocal_rank_fusion_ties_keep_the_order_of_the_first_list():
+    assert reciprocal_rank_fusion([[4, 5], [5, 4]], k=60) == [4, 5]
+    assert reciprocal_rank_fusion([[7, 8, 9]]) == [7, 8, 9]
+
+
+def test_tokenize_drops_stopwords_and_field_labels_and_folds_plurals():
+    assert tokenize("Division: Workers | Title: the Pipes and Glass") == ["worker", "pipe", "glass"]
+
+
+def test_bm25_finds_exact_titles():
+    index = build_index()
+    assert index.top_k("dhobi", 3).tolist() == [0]
+    assert index.top_k("anganwadi workers", 3)[0] == 2
+    assert index.top_k("taxi", 5).tolist() == [3]
+
+
+def test_bm25_ranks_by_term_frequency_and_only_returns_matches():
+    index = build_index()
+    ranked = index.top_k("pipes", 5).tolist()
+    assert ranked == [4, 1]         # the pipe fitter document repeats the term
+    assert index.top_k("astronaut", 5).size == 0
+
+
+def test_bm25_top_k_restricted_to_rows():
+    index = build_index()
+    assert index.top_k("pipes", 5, rows=np.array([1, 3])).tolist() == [1]
+
+
+def test_cache_is_reused_for_the_same_version(tmp_path):
+    built = build_index(tmp_path)
+    cached = LexicalIndex(cache_dir=tmp_path)
+    cached.load("catalogue", "v1", [""] * len(DOCUMENTS), [{}] * len(DOCUMENTS))     # the documents are not read again
+    assert cached.top_k("plumber", 3).tolist() == built.top_k("plumber", 3).tolist() == [1]
+    rebuilt = LexicalIndex(cache_dir=tmp_path)
+    rebuilt.load("catalogue", "v2", [""] * len(DOCUMENTS), [{}] * len(DOCUMENTS))
+    assert rebuilt.top_k("plumber", 3).size == 0
@@ -0,0 +1,105 @@
+import asyncio
+from langchain_core.messages import HumanMessage
+from app.src.llm_dispatcher import PRIORITY_BATCH, PRIORITY_RESUME, LLMDispatcher
+
+
+class FakeRunnable:
+
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.calls = []
+
+    async def ainvoke(self, messages, config=None):
+        self.calls.append(messages[-1].content)
+        await asyncio.sleep(self.delay)
+        return f"answer to {messages[-1].content}"
+
+
+def test_cancelled_queued_call_never_runs():
+    async def scenario():
+        dispatcher = LLMDispatcher(requests_per_minute=0, tokens_per_minute=0, max_concurrency=1)
+        runnable = FakeRunnable()
+        first = asyncio.create_task(dispatcher.ainvoke(runnable, [HumanMessage(content="first")]))
+        queued = asyncio.create_task(dispatcher.ainvoke(runnable, [HumanMessage(content="queued")]))
+        await asyncio.sleep(0.01)
+        queued.cancel()
+        assert await first == "answer to first"
+        await asyncio.sleep(0.1)
+        return dispatcher, runnable, queued
+
+    dispatcher, runnable, queued = asyncio.run(scenario())
+    assert queued.cancelled()
+    assert runnable.calls == ["first"]
+    assert dispatcher.queue == [] and dispatcher.in_flight == {}
+    assert dispatcher.stats()["dropped"] == 1
+
+
+def test_queued_call_runs_while_a_coalesced_caller_waits():
+    async def scenario():
+        dispatcher = LLMDispatcher(requests_per_minute=0, tokens_per_minute=0, max_concurrency=1)
+        runnable = FakeRunnable()
+        first = asyncio.create_task(dispatcher.ainvoke(runnable, [HumanMessage(content="first")]))
+        cancelled = asyncio.create_task(dispatcher.ainvoke(runnable, [HumanMessage(content="shared")]))
+        waiting = asyncio.create_task(dispatcher.ainvoke(runnable, [HumanMessage(content="shared")]))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await first
+        return dispatcher, runnable, await waiting
+
+    dispatcher, runnable, answer = asyncio.run(scenario())
+    assert answer == "answer to shared"
+    assert runnable.calls == ["first", "shared"]
+    assert dispatcher.stats()["dropped"] == 0 and dispatcher.stats()["coalesced"] == 1
+
+
+def test_running_calls_are_referenced_until_done():
+    async def scenario():
+        dispatcher = LLMDispatcher(requests_per_minute=0, tokens_per_minute=0, max_concurrency=2)
+        call = asyncio.create_task(dispatcher.ainvoke(FakeRunnable(), [HumanMessage(content="x")]))
+        await asyncio.sleep(0.01)
+        running = len(dispatcher.tasks)
+        await call
+        await asyncio.sleep(0)
+        return running, len(dispatcher.tasks)
+
+    assert asyncio.run(scenario()) == (1, 0)
+
+
+class FailingRunnable(FakeRunnable):
+
+    async def ainvoke(self, messages, config=None):
+        await super().ainvoke(messages, config)
+        raise RuntimeError("groq is down")
+
+
+def test_failed_call_without_waiters_retrieves_its_exception():
+    async def scenario():
+        dispatcher = LLMDispatcher(requests_per_minute=0, tokens_per_minute=0, max_concurrency=1)
+        call = asyncio.create_task(dispatcher.ainvoke(FailingRunnable(), [HumanMessage(content="x")]))
+        await asyncio.sleep(0.01)
+        job = next(iter(dispatcher.in_flight.values()))
+        call.cancel()
+        await asyncio.sleep(0.1)
+        return dispatcher, job
+
+    dispatcher, job = asyncio.run(scenario())
+    assert job.future._log_traceback is False       # no "Future exception was never retrieved"
+    assert job.started and isinstance(job.future.exception(), RuntimeError)
+    assert dispatcher.stats()["failed"] == 1
+
+
+def test_coalesced_caller_raises_the_priority_of_a_queued_call():
+    async def scenario():
+        dispatcher = LLMDispatcher(requests_per_minute=0, tokens_per_minute=0, max_concurrency=1)
+        runnable = FakeRunnable()
+        tasks = [asyncio.create_task(dispatcher.ainvoke(runnable, [HumanMessage(content=content)], priority=PRIORITY_BATCH)) for content in ("running", "batch", "shared")]
+        await asyncio.sleep(0.01)
+        tasks.append(asyncio.create_task(dispatcher.ainvoke(runnable, [HumanMessage(content="shared")], priority=PRIORITY_RESUME)))
+        await asyncio.sleep(0.01)
+        queued = [(priority, job.messages[-1].content) for priority, _, job in sorted(dispatcher.queue)]
+        await asyncio.gather(*tasks)
+        return runnable, queued
+
+    runnable, queued = asyncio.run(scenario())
+    assert queued == [(PRIORITY_RESUME, "shared"), (PRIORITY_BATCH, "batch")]
+    assert runnable.calls == ["running", "shared", "batch"]
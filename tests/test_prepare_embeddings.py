@@ -0,0 +1,65 @@
+import pandas as pd
+import pytest
+from prepare_embeddings import catalogue_ids, catalogue_version, content_hash, diff_catalogue, get_metadatas, load_dataset, stored_hashes
+
+
+def test_diff_catalogue_finds_new_changed_and_removed_codes():
+    ids = ["1111.0100", "2222.0100", "3333.0100"]
+    hashes = ["a", "b-edited", "c"]
+    existing = {"2222.0100": "b", "3333.0100": "c", "9999.0100": "z"}
+    new, changed, removed = diff_catalogue(ids, hashes, existing)
+    assert new == [0]
+    assert changed == [1]
+    assert removed == ["9999.0100"]
+
+
+def test_diff_catalogue_reembeds_rows_stored_without_a_hash():
+    _, changed, _ = diff_catalogue(["1111.0100"], ["a"], {"1111.0100": None})
+    assert changed == [0]
+
+
+def test_diff_catalogue_of_an_unchanged_catalogue_is_empty():
+    assert diff_catalogue(["1", "2"], ["a", "b"], {"1": "a", "2": "b"}) == ([], [], [])
+
+
+def test_catalogue_version_ignores_the_order_and_follows_the_content():
+    version = catalogue_version({"1111.0100": "a", "2222.0100": "b"})
+    assert version == catalogue_version({"2222.0100": "b", "1111.0100": "a"})
+    assert version != catalogue_version({"1111.0100": "a", "2222.0100": "b-edited"})
+    assert version != catalogue_version({"1111.0100": "a"})
+    assert len(version) == 16
+
+
+def test_content_hash_covers_the_document_and_the_metadata():
+    metadata = {"occupation_code": "7126.0100", "division_name": "Craft and Related Trades Workers"}
+    assert content_hash("Plumber", metadata) == content_hash("Plumber", dict(reversed(list(metadata.items()))))
+    assert content_hash("Plumber", metadata) != content_hash("Plumber, General", metadata)
+    assert content_hash("Plumber", metadata) != content_hash("Plumber", {**metadata, "division_name": "Elementary Occupations"})
+
+
+def test_load_dataset_keeps_the_legacy_code_format_and_rejects_duplicates(tmp_path):
+    columns = {"code": ["2221.0100", "7126.0100"], "title": ["Nurse", "Plumber"], "family_name": ["f", "g"],
+               "division_name": ["Professionals", "Craft and Related Trades Workers"], "description": ["d", "e"], "final_title": ["x", "y"]}
+    dataset = tmp_path / "dataset.csv"
+    pd.DataFrame(columns).to_csv(dataset, index=False)
+    df = load_dataset(dataset)
+    assert catalogue_ids(df) == ["2221.01", "7126.01"]
+    assert get_metadatas(df)[1] == {"occupation_code": 7126.01, "family_name": "g", "division_name": "Craft and Related Trades Workers", "occupation_title": "Plumber"}
+
+    pd.DataFrame({key: values + values[:1] for key, values in columns.items()}).to_csv(dataset, index=False)
+    with pytest.raises(ValueError, match="Duplicate codes"):
+        load_dataset(dataset)
+
+
+def test_stored_hashes_hashes_legacy_rows_from_their_stored_content():
+    legacy_metadata = {"occupation_code": 7126.01, "family_name": "g", "division_name": "Craft and Related Trades Workers", "occupation_title": "Plumber"}
+    stored = {
+        "ids": ["2221.01", "7126.01"],
+        "documents": ["Nurse", "Plumber"],
+        "metadatas": [{"occupation_code": 2221.01, "content_hash": "a"}, legacy_metadata]
+    }
+    existing, legacy = stored_hashes(stored)
+    assert existing == {"2221.01": "a", "7126.01": content_hash("Plumber", legacy_metadata)}
+    assert legacy == ["7126.01"]
+    _, changed, _ = diff_catalogue(["7126.01"], [content_hash("Plumber", dict(legacy_metadata))], existing)
+    assert changed == []            # unchanged legacy rows are not embedded again
@@ -0,0 +1,47 @@
+import hashlib
+import json
+from app.src.prompts import prompt_builder
+from app.src.schemas import ExpanderOutput
+
+
+'''
+The static prefix(system message) of the expander and analyzer prompts must be byte-identical across calls for the provider-side
+prompt caching. The hashes are pinned: an edit of the prompt text fails here, update PINNED_HASHES when the edit is deliberate.
+'''
+
+PINNED_HASHES = {
+    "expander": "770e82badea73761",
+    "analyzer": "a2072dd25caa1a16"
+}
+
+SAMPLES = [
+    ("I am a nurse in a government hospital", ExpanderOutput(reasoning="a", division_reason="b", is_query_generated=False), None, 2),
+    ("I drive a taxi", ExpanderOutput(reasoning="c", division_reason="d", is_query_generated=True, query="Division: Plant and Machine Operators and Assemblers | Title: Taxi Driver"), None, 1)
+]
+
+
+def serialize(messages) -> bytes:
+    return json.dumps([[message.type, message.content] for message in messages], ensure_ascii=False).encode("utf-8")
+
+
+def built_prefixes(prompt: str):
+    if prompt == "expander":
+        return [prompt_builder.build_expander_messages(user_input)[:len(prompt_builder.EXPANDER_PREFIX)] for user_input, *_ in SAMPLES]
+    return [prompt_builder.build_analyzer_messages(*sample)[:len(prompt_builder.ANALYZER_PREFIX)] for sample in SAMPLES]
+
+
+def test_expander_prefix_is_identical_across_inputs():
+    first, second = (serialize(prefix) for prefix in built_prefixes("expander"))
+    assert first == second
+
+
+def test_analyzer_prefix_is_identical_across_inputs():
+    first, second = (serialize(prefix) for prefix in built_prefixes("analyzer"))
+    assert first == second
+
+
+def test_prefixes_match_the_pinned_hashes():
+    for prompt, pinned in PINNED_HASHES.items():
+        serialized = serialize(built_prefixes(prompt)[0])
+        assert hashlib.sha256(serialized).hexdigest()[:16] == pinned, f"the {prompt} system prompt changed, update PINNED_HASHES if it is deliberate"
+        assert prompt_builder.PREFIX_HASHES[prompt] == prompt_builder.prefix_hash(built_prefixes(prompt)[0])
@@ -0,0 +1,44 @@
+import numpy as np
+from app.utils import QueryEmbeddingCache
+
+
+def test_normalize_ignores_case_spacing_and_trailing_dots():
+    key = QueryEmbeddingCache.normalize("Division: Craft Workers | Title: Plumber | Description: fits pipes")
+    assert QueryEmbeddingCache.normalize("  division :craft   workers|title:  PLUMBER |description : fits pipes. ") == key
+    assert key == "division: craft workers| title: plumber| description: fits pipes"
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = QueryEmbeddingCache(max_size=2)
+    cache.put("a", np.zeros(3, dtype=np.float32))
+    cache.put("b", np.ones(3, dtype=np.float32))
+    assert cache.get("a") is not None       # "b" is now the least recently used
+    cache.put("c", np.full(3, 2, dtype=np.float32))
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.get("b") is None
+    assert cache.stats() == {"size": 2, "hits": 1, "misses": 1}
+
+
+def test_save_replaces_the_file_atomically_and_load_restores_the_entries(tmp_path):
+    persist_path = tmp_path / "cache" / "query_embeddings.npz"
+    cache = QueryEmbeddingCache(persist_path=persist_path)
+    cache.put("nurse", np.array([1, 0, 0], dtype=np.float32))
+    cache.put("plumber", np.array([0, 1, 0], dtype=np.float32))
+    cache.save()
+    assert [path.name for path in persist_path.parent.iterdir()] == ["query_embeddings.npz"]      # no temp file left behind
+
+    restored = QueryEmbeddingCache(persist_path=persist_path)
+    restored.load()
+    assert list(restored.entries) == ["nurse", "plumber"]
+    np.testing.assert_array_equal(restored.get("plumber"), [0, 1, 0])
+
+
+def test_load_skips_embeddings_of_another_model(tmp_path):
+    persist_path = tmp_path / "query_embeddings.npz"
+    cache = QueryEmbeddingCache(persist_path=persist_path)
+    cache.put("nurse", np.ones(3, dtype=np.float32))
+    cache.save()
+    restored = QueryEmbeddingCache(persist_path=persist_path)
+    restored.MODEL_NAME = "another-model"
+    restored.load()
+    assert restored.entries == {}
@@ -0,0 +1,44 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+from app import checkpoint_store, metrics
+from app.deletion_queue import REMOVE_DONE
+from app.reaper import CLOSE_IDLE_SESSIONS, Reaper
+
+
+def closed_rows(count: int) -> list:
+    return [SimpleNamespace(thread_id=uuid.uuid4()) for _ in range(count)]
+
+
+def test_run_once_closes_batches_until_one_is_short_and_counts_what_was_reclaimed(fake_db, monkeypatch):
+    deleted_batches = []
+
+    async def delete_threads(thread_ids, concurrency):
+        deleted_batches.append(thread_ids)
+        return 4 * len(thread_ids)          # checkpoint rows of the threads
+
+    monkeypatch.setattr(checkpoint_store, "delete_threads", delete_threads)
+    monkeypatch.setattr(metrics, "REAPER_RECLAIMED", metrics.Counter("reaper_reclaimed_total", "-", ("kind",)))
+    batches = [closed_rows(2), closed_rows(1)]
+    fake_db.responses[CLOSE_IDLE_SESSIONS] = [list(batch) for batch in batches]
+
+    report = asyncio.run(Reaper(ttl=3600, interval=60, batch_size=2).run_once())
+
+    assert report == {"sessions_closed": 3, "threads_deleted": 3, "checkpoint_rows_deleted": 12}
+    assert fake_db.params_of(CLOSE_IDLE_SESSIONS) == [{"ttl": 3600.0, "batch_size": 2}] * 2
+    assert deleted_batches == [[str(row.thread_id) for row in batch] for batch in batches]
+    assert fake_db.params_of(REMOVE_DONE) == [{"thread_ids": [row.thread_id for row in batch]} for batch in batches]
+    assert metrics.REAPER_RECLAIMED.values == {("sessions_closed",): 3, ("threads_deleted",): 3, ("checkpoint_rows_deleted",): 12}
+
+
+def test_run_once_without_idle_sessions_deletes_nothing(fake_db, monkeypatch):
+    async def delete_threads(thread_ids, concurrency):
+        raise AssertionError("nothing to delete")
+
+    monkeypatch.setattr(checkpoint_store, "delete_threads", delete_threads)
+    monkeypatch.setattr(metrics, "REAPER_RECLAIMED", metrics.Counter("reaper_reclaimed_total", "-", ("kind",)))
+
+    report = asyncio.run(Reaper(ttl=3600, interval=60, batch_size=2).run_once())
+
+    assert report == {"sessions_closed": 0, "threads_deleted": 0, "checkpoint_rows_deleted": 0}
+    assert [statement for statement, _ in fake_db.executed] == [CLOSE_IDLE_SESSIONS]
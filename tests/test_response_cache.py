@@ -0,0 +1,55 @@
+import numpy as np
+from app.src import response_cache as response_cache_module
+from app.src.response_cache import ResponseCache
+from app.src.schemas import AnalyzerOutput
+
+
+def analyzer_output(status: str = "MATCH_FOUND") -> AnalyzerOutput:
+    return AnalyzerOutput(thought_process="-", status=status, selected_code="7126.0100", selected_title="Plumber",
+                          confidence_score=9, system_directive="-", user_message="Occupation Code- 7126.0100 (Plumber)")
+
+
+NURSE = np.array([1.0, 0.0, 0.0])
+PLUMBER = np.array([0.0, 1.0, 0.0])
+
+
+def test_similar_embedding_hits_and_a_different_one_misses():
+    cache = ResponseCache(threshold=0.95)
+    cache.put(NURSE, analyzer_output(), "v1")
+    assert cache.get(NURSE * 2 + [0.0, 0.1, 0.0], "v1").selected_code == ["7126.0100"]      # cosine similarity ~0.999
+    assert cache.get(PLUMBER, "v1") is None
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+
+def test_only_match_found_and_more_info_are_cached():
+    cache = ResponseCache()
+    cache.put(NURSE, analyzer_output("IMPROVED_SEARCH"), "v1")
+    assert cache.entries == {}
+    cache.put(NURSE, analyzer_output("MORE_INFO"), "v1")
+    assert cache.get(NURSE, "v1").status == "MORE_INFO"
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache_module.time, "monotonic", lambda: now[0])
+    cache = ResponseCache(ttl=60)
+    cache.put(NURSE, analyzer_output(), "v1")
+    now[0] += 59
+    assert cache.get(NURSE, "v1") is not None
+    now[0] += 2
+    assert cache.get(NURSE, "v1") is None
+    assert cache.entries == {}
+
+
+def test_a_new_catalogue_version_drops_every_entry():
+    cache = ResponseCache()
+    cache.put(NURSE, analyzer_output(), "v1")
+    assert cache.get(NURSE, "v2") is None
+    assert cache.entries == {} and cache.version == "v2"
+
+
+def test_cached_output_is_a_copy():
+    cache = ResponseCache()
+    cache.put(NURSE, analyzer_output(), "v1")
+    cache.get(NURSE, "v1").user_message = "edited"
+    assert cache.get(NURSE, "v1").user_message == "Occupation Code- 7126.0100 (Plumber)"
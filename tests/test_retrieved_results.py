@@ -0,0 +1,30 @@
+from app.utils import compact_results, merge_retrieved_results
+
+
+def chroma_shaped(ids, distances) -> dict:
+    return {"ids": [ids], "distances": [distances], "documents": [["-"] * len(ids)], "metadatas": [[{}] * len(ids)]}
+
+
+def test_merge_keeps_the_old_order_and_the_best_distance_of_a_repeated_code():
+    old = {"ids": ["7411.0100", "7412.0200"], "distances": [0.8, 0.9]}
+    new = chroma_shaped(["7412.0200", "8322.0100", "7411.0100"], [0.4, 0.7, 1.2])
+    assert merge_retrieved_results(old, new) == {"ids": ["7411.0100", "7412.0200", "8322.0100"], "distances": [0.8, 0.4, 0.7]}
+
+
+def test_merge_with_missing_results():
+    results = {"ids": ["7411.0100"], "distances": [0.5]}
+    assert merge_retrieved_results(None, results) == results
+    assert merge_retrieved_results(chroma_shaped(["7411.0100"], [0.5]), None) == results
+    assert merge_retrieved_results(None, None) is None
+
+
+def test_speculative_hits_are_added_after_the_expander_hits():
+    expander = chroma_shaped(["2221.0100", "3221.0100"], [0.6, 0.7])
+    speculative = {"ids": ["3221.0100", "5321.0100"], "distances": [0.5, 0.9]}
+    assert merge_retrieved_results(expander, speculative) == {"ids": ["2221.0100", "3221.0100", "5321.0100"], "distances": [0.6, 0.5, 0.9]}
+
+
+def test_compact_results_keeps_only_codes_and_float_distances():
+    assert compact_results(chroma_shaped(["2221.0100"], [1])) == {"ids": ["2221.0100"], "distances": [1.0]}
+    assert compact_results({"ids": [], "distances": []}) == {"ids": [], "distances": []}
+    assert compact_results(None) is None